@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Benchmark hot queries with and without the schema's secondary indexes.
+
+Generates a large dataset in a fresh SQLite database, then for every query
+records its plan (``EXPLAIN QUERY PLAN``) and average timing, first with
+all secondary indexes dropped and then with them created.
+
+Usage::
+
+    python scripts/benchmark_indexes.py [scale] [sqlite database url]
+
+Only SQLite is supported, the queries use its parameter style and
+``EXPLAIN QUERY PLAN``.
+
+"""
+import sys
+import time
+import random
+import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+from sis.model import Base, Person
+
+# name, SQL, parameters
+QUERIES = [
+    ('lessons by teacher',
+     'SELECT * FROM lessons WHERE schedule_id = ? AND teacher_id = ? '
+     'AND day = ? AND "order" = ?', (3, 17, 2, 4)),
+    ('lessons by group',
+     'SELECT * FROM lessons WHERE schedule_id = ? AND group_id = ? '
+     'AND day = ?', (3, 42, 1)),
+    ('lessons by room',
+     'SELECT * FROM lessons WHERE schedule_id = ? AND room = ? '
+     'AND day = ? AND "order" = ?', (3, 21, 3, 5)),
+    ('substitutions by date',
+     'SELECT * FROM substitutions WHERE date = ?', ('2010-03-15',)),
+    ('lucky numbers by number',
+     'SELECT * FROM lucky_numbers WHERE number = ?', (13,)),
+    # Prefix search, the way Person.query_search looks names up
+    ('people by last name',
+     'SELECT * FROM people WHERE search_name >= ? AND search_name < ? '
+     'ORDER BY search_name', (u'nowak17', u'nowak17\uffff')),
+    ('group members',
+     'SELECT * FROM groups_memberships WHERE group_id = ?', (42,)),
+]
+
+def generate(engine, scale):
+    """Fill the database with ``scale`` times a single school's data."""
+    t = Base.metadata.tables
+    rand = random.Random(0)
+    conn = engine.connect()
+    trans = conn.begin()
+
+    years = [{'id': i + 1, 'start': datetime.date(2007 + i, 9, 1),
+              'end': datetime.date(2008 + i, 6, 30)} for i in range(3)]
+    conn.execute(t['school_years'].insert(), years)
+    conn.execute(t['schedules'].insert(), [
+        {'id': i + 1, 'year_id': y['id'], 'start': y['start'],
+         'updated': y['start']} for i, y in enumerate(years)])
+    conn.execute(t['subjects'].insert(), [
+        {'id': i + 1, 'name': u'subject %d' % i, 'short': u's%d' % i}
+        for i in range(40)])
+
+    teachers = 100 * scale
+    groups = 40 * scale
+    students = 30 * groups
+    people = []
+    for i in range(teachers + students):
+        last_name = u'Nowak%d' % rand.randint(0, students)
+        people.append({'id': i + 1, 'first_name': u'Jan',
+                       'second_name': None, 'last_name': last_name,
+                       'search_name': Person.fold(last_name),
+                       'is_male': True})
+    conn.execute(t['people'].insert(), people)
+    conn.execute(t['educators'].insert(), [
+        {'id': i + 1, 'title': u'mgr'} for i in range(teachers)])
+    conn.execute(t['students'].insert(), [
+        {'id': teachers + i + 1} for i in range(students)])
+
+    conn.execute(t['groups'].insert(), [
+        {'id': i + 1, 'name': u'g%d' % i, 'year_id': i % 3 + 1}
+        for i in range(groups)])
+    conn.execute(t['groups_memberships'].insert(), [
+        {'student_id': teachers + i + 1, 'group_id': i // 30 + 1,
+         'second_part': i % 30 >= 15, 'since': years[0]['start'],
+         'to': None, 'active': True} for i in range(students)])
+
+    lessons = []
+    for schedule in range(1, 4):
+        for group in range(1, groups + 1):
+            for day in range(5):
+                for order in range(1, 8):
+                    lessons.append({
+                        'schedule_id': schedule, 'group_id': group,
+                        'first_part': True, 'second_part': True,
+                        'subject_id': rand.randint(1, 40),
+                        'teacher_id': rand.randint(1, teachers),
+                        'day': day, 'order': order,
+                        'room': rand.randint(1, 60)})
+    conn.execute(t['lessons'].insert(), lessons)
+
+    start = datetime.date(2007, 9, 1)
+    conn.execute(t['substitutions'].insert(), [
+        {'date': start + datetime.timedelta(i // (10 * scale)),
+         'order': i % 7 + 1, 'group_id': i % groups + 1,
+         'part1': True, 'part2': True,
+         'teacher_id': rand.randint(1, teachers), 'comment': None}
+        for i in range(1000 * 10 * scale)])
+    conn.execute(t['lucky_numbers'].insert(), [
+        {'date': start + datetime.timedelta(i), 'number': i % 36 + 1}
+        for i in range(1000 * scale)])
+
+    trans.commit()
+    conn.close()
+
+def indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            yield index
+
+def measure(engine, repeat=50):
+    """Return (name, plan, average time in ms) for every query."""
+    results = []
+    for name, sql, params in QUERIES:
+        plan = engine.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        plan = '; '.join(str(tuple(row)[-1]) for row in plan)
+        start = time.time()
+        for x in range(repeat):
+            engine.execute(sql, params).fetchall()
+        elapsed = (time.time() - start) * 1000 / repeat
+        results.append((name, plan, elapsed))
+    return results
+
+def main(scale=10, url='sqlite://'):
+    if make_url(url).drivername.split('+')[0] != 'sqlite':
+        sys.exit("Only SQLite databases are supported.")
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    generate(engine, scale)
+
+    for index in indexes():
+        index.drop(bind=engine)
+    before = measure(engine)
+
+    for index in indexes():
+        index.create(bind=engine)
+    engine.execute('ANALYZE')
+    after = measure(engine)
+
+    for (name, plan_before, t_before), (_, plan_after, t_after) in \
+            zip(before, after):
+        print("%s:\n  before %8.3f ms  %s\n  after  %8.3f ms  %s" %
+              (name, t_before, plan_before, t_after, plan_after))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 0:
+        args[0] = int(args[0])
+    main(*args)
@@ -7,6 +7,7 @@ from sqlalchemy import engine_from_config
 
 import sis.lib.app_globals as app_globals
 import sis.lib.helpers
+import sis.lib.pdf
 from sis.config.routing import make_map
 from sis.model import init_model
 
@@ -43,4 +44,7 @@ def load_environment(global_conf, app_conf):
     # CONFIGURATION OPTIONS HERE (note: all config options will override
     # any Pylons config options)
 
+    # Fonts have to be registered only once
+    sis.lib.pdf.register_fonts()
+
     return config
@@ -27,6 +27,7 @@ def make_map(config):
         m.connect('lucky_current', r'/current', action='current')
         m.connect('lucky_week', r'/week', action='current_week')
         m.connect('lucky_week_pdf', r'/week.pdf', action='current_week_pdf')
+        m.connect('lucky_weeks_pdf', r'/weeks.pdf', action='weeks_pdf')
         m.connect('lucky_left', r'/left', action='left')
         m.connect('lucky_draw', r'/draw', action='draw')
         m.connect('lucky_all', r'/all', action='all')
@@ -41,17 +42,26 @@ def make_map(config):
     with map.submapper(controller='substitutions') as m:
         m.connect(r'', action='index')
 
+        # substitutions tables for the whole week
+        with m.submapper(path_prefix='/z/week', action='week') as week_m:
+            week_m.connect('substitutions_week', r'')
+            week_m.connect('substitutions_week_date',
+                    r'/{date:\d\d\d\d-\d\d-\d\d}')
+
         # substitutions table
         with m.submapper(path_prefix='/z', action='table') as table_m:
             table_m.connect('substitutions_table', r'')
             table_m.connect('substitutions_table_date',
                     r'/{date:\d\d\d\d-\d\d-\d\d}')
+    map.connect('substitutions_suggest', r'/substitutions/suggest',
+                controller='substitutions', action='suggest')
     # substitutions RESTful mapping
     map.resource('substitution', 'substitutions')
 
     # Now! routes
     with map.submapper(path_prefix='/now', controller='now') as m:
         m.connect('now_home', r'', action='index')
+        m.connect('now_autocomplete', '/autocomplete', action='autocomplete')
         m.connect('now_id', '/{id:\d+}', action='now_id')
         m.connect('now_name', '/{surname}', action='now')
 
@@ -62,6 +72,14 @@ def make_map(config):
         # full schedules
         m.connect('schedule_teachers', r'/teachers', action='teachers')
         m.connect('schedule_groups', r'/groups', action='groups')
+        m.connect('schedule_conflicts', r'/conflicts', action='conflicts')
+
+        # rooms
+        m.connect('schedule_rooms_free', r'/rooms/free', action='free_rooms')
+        m.connect('schedule_room', r'/room/{room:\d+}', action='room')
+
+        # common free periods of groups and teachers
+        m.connect('schedule_free', r'/free', action='free_periods')
 
         # weekly schedules
         with m.submapper(path_prefix='/week') as week_m:
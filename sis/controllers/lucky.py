@@ -1,19 +1,15 @@
 # -*- coding: utf-8 -*-
 import datetime
+import threading
 
 import logging
 log = logging.getLogger(__name__)
 
-from pkg_resources import Requirement, resource_filename
-
-import StringIO
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+import hashlib
 
 from pylons import request, response, session, tmpl_context as c, url
-from pylons.controllers.util import abort, redirect
+from pylons import app_globals
+from pylons.controllers.util import abort, redirect, etag_cache
 
 from sqlalchemy.exceptions import IntegrityError
 
@@ -26,19 +22,48 @@ from repoze.what.plugins.pylonshq import ActionProtector
 import formencode
 from formencode import htmlfill
 
+from sis.lib import pdf
 from sis.lib.base import BaseController, render
+from sis.lib.auth.helpers import signed_in
 from sis.model.meta import Session
-from sis.model import LuckyNumber
+from sis.model import LuckyNumber, LuckyCurrent
 
 from sis.forms import AddLuckyNumbersForm, SearchLuckyForm
 
 
 class LuckyController(BaseController):
 
+    # Rendered PDFs and their ETags by (date, number) pairs of the weeks,
+    # and the pairs least recently used first
+    _documents = {}
+    _used = []
+    _lock = threading.Lock()
+
+    # Number of PDFs kept at once, the least recently used are dropped
+    pdf_cache_size = 8
+
+    def _current(self):
+        """
+        Return current lucky numbers (see :class:`sis.model.LuckyCurrent`)
+        and let the response expire together with them.
+
+        Only pages of anonymous users without flash messages are
+        allowed to be cached by proxies.
+
+        """
+        current = LuckyCurrent.get(app_globals.lucky_change_hour)
+        response.cache_expires(current.seconds_left())
+        if signed_in() is None and 'flash' not in session:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.vary = ('Cookie',)
+        return current
+
     def index(self):
-        change_hour = 15
-        c.current = LuckyNumber.current(change_hour)
-        c.week = LuckyNumber.current_week(change_hour)
+        current = self._current()
+        c.current = current.lucky
+        c.week = current.week
         c.left = LuckyNumber.left()
         return render('lucky/index.xml')
 
@@ -93,9 +118,7 @@ class LuckyController(BaseController):
         return render('lucky/list.xml')
 
     def current(self):
-        # TODO This could be set in the settings file
-        change_hour = 15
-        c.lucky = LuckyNumber.current(change_hour)
+        c.lucky = self._current().lucky
         return render('lucky/current.xml')
 
     def date(self, date):
@@ -114,62 +137,90 @@ class LuckyController(BaseController):
         Lucky numbers for current or next week.
 
         """
-        change_hour = 15
-        c.numbers = LuckyNumber.current_week(change_hour)
+        c.numbers = self._current().week
         return render('lucky/week.xml')
 
+    def _pdf(self, weeks):
+        """
+        Return PDF with lucky numbers of the weeks (lists of lucky numbers).
+
+        Documents are cached by their (date, number) pairs and served with
+        a strong ETag, so unchanged numbers are rendered only once and
+        browsers may reuse what they already have. Ranges are chosen by
+        clients, so only the last few documents are kept (see
+        :attr:`pdf_cache_size`).
+
+        """
+        key = tuple(tuple((n.date, n.number) for n in week) for week in weeks)
+
+        cls = self.__class__
+        cls._lock.acquire()
+        try:
+            cached = cls._documents.get(key)
+            if cached is not None:
+                cls._used.remove(key)
+                cls._used.append(key)
+        finally:
+            cls._lock.release()
+
+        if cached is None:
+            document = pdf.lucky_numbers([list(week) for week in key])
+            cached = document, hashlib.sha1(document).hexdigest()
+            cls._lock.acquire()
+            try:
+                if key not in cls._documents:
+                    cls._used.append(key)
+                cls._documents[key] = cached
+                while len(cls._used) > cls.pdf_cache_size:
+                    del cls._documents[cls._used.pop(0)]
+            finally:
+                cls._lock.release()
+
+        document, etag = cached
+        etag_cache(etag)
+        response.headers['Content-type'] = 'application/pdf'
+        return document
+
     @ActionProtector(not_anonymous())
     def current_week_pdf(self):
         """Lucky numbers for current or next week in pdf format."""
-        change_hour = 15
-        numbers = LuckyNumber.current_week(change_hour)
+        numbers = LuckyCurrent.get(app_globals.lucky_change_hour).week
 
         if len(numbers) == 0:
             return redirect(url('lucky_week'))
 
-        # Register fonts
-        ubuntu_r = resource_filename(Requirement.parse("SIS"), "resources/Ubuntu-R.ttf")
-        ubuntu_b = resource_filename(Requirement.parse("SIS"), "resources/Ubuntu-B.ttf")
-        pdfmetrics.registerFont(TTFont('Ubuntu', ubuntu_r))
-        pdfmetrics.registerFont(TTFont('Ubuntu Bold', ubuntu_b))
-
-        numbers_pdf = StringIO.StringIO()
-        doc = SimpleDocTemplate(numbers_pdf, pagesize=A4, topMargin=A4[1]*0.26)
-        doc.author = 'SIS'
-        doc.title = 'Szczęśliwy numerek'
-
-        data = []
-        for number in numbers:
-            date = number.date.strftime("%d.%m.%y")
-            data.append(('{0} -'.format(date), str(number.number)))
-
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('FONT', (0, 0), (0, -1), 'Ubuntu', 80),
-            ('FONT', (1, 0), (1, -1), 'Ubuntu Bold', 80),
-        ]))
-
-        def header_and_footer(canvas, document):
-            canvas.saveState()
-            size = document.pagesize
-            center = size[0] / 2
-
-            canvas.setFont('Ubuntu', 80)
-            canvas.drawCentredString(center,
-                size[1] - document.topMargin / 2, "SZCZĘŚLIWY")
-            canvas.drawCentredString(center, size[1] - document.topMargin + 20, 'NUMEREK')
+        return self._pdf([numbers])
 
-            canvas.setFont('Ubuntu', 15)
-            canvas.drawRightString(size[0] - document.rightMargin,
-                document.bottomMargin - 20, "Samorząd Uczniowski")
-
-            canvas.restoreState()
+    @ActionProtector(not_anonymous())
+    def weeks_pdf(self):
+        """
+        Lucky numbers from the ``since`` date (beginning of the current
+        week by default) until the ``until`` date (all drawn numbers
+        by default) in pdf format, one page per week.
 
-        doc.build([table], onFirstPage=header_and_footer,
-            onLaterPages=header_and_footer)
+        """
+        today = datetime.date.today()
+        since = self._date_param('since') or \
+                today - datetime.timedelta(today.weekday())
+        until = self._date_param('until')
+
+        q = Session.query(LuckyNumber).filter(LuckyNumber.date >= since)
+        if until is not None:
+            q = q.filter(LuckyNumber.date <= until)
+
+        weeks = []
+        monday = None
+        for number in q.order_by(LuckyNumber.date):
+            date = number.date - datetime.timedelta(number.date.weekday())
+            if date != monday:
+                monday = date
+                weeks.append([])
+            weeks[-1].append(number)
+
+        if len(weeks) == 0:
+            return redirect(url('lucky_week'))
 
-        response.headers['Content-type'] = 'application/pdf'
-        return numbers_pdf.getvalue()
+        return self._pdf(weeks)
 
     def draw(self):
         c.numbers = LuckyNumber.draw()
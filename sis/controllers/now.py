@@ -1,14 +1,14 @@
-from datetime import time, datetime
+from datetime import datetime
 
 import logging
 log = logging.getLogger(__name__)
 
 from pylons import request, response, session, tmpl_context as c, url
 from pylons.controllers.util import abort, redirect
+from pylons.decorators import jsonify
 
 from sis.lib.base import BaseController, render
-from sis.model import Student, Educator, Schedule
-from sis.model.meta import Session
+from sis.model import NowTable, ScheduleVersion, BellSchedule, DateTimetable
 
 
 class NowController(BaseController):
@@ -24,60 +24,86 @@ class NowController(BaseController):
         else:
             return render('now/index.xml')
 
+    @jsonify
+    def autocomplete(self):
+        """
+        Return people whose last names start with the ``q`` param
+        (ignoring case and diacritics).
+
+        """
+        prefix = request.params.get('q', '')
+        if len(prefix) == 0:
+            return {'people': []}
+        people = NowTable.current().complete(prefix)
+        return {'people': [{'id': p.id, 'name': p.name} for p in people]}
+
     def current_order(self):
         """
         Return the current lesson order.
 
-        """
-        schedule = [time(7,55),
-                    time(8,55),
-                    time(10,0),
-                    time(10,55),
-                    time(12,0),
-                    time(12,55),
-                    time(13,50),
-                    time(14,45)]
-
-        now = datetime.now().time()
-
-        if now < schedule[0] or now > schedule[-1]:
-            return
-
-        order = 0
-        for t in schedule:
-            if now >= t:
-                order += 1
-            if now < t:
-                break
+        The answer holds until the next bell, so the response expires then.
 
+        """
+        order, next_order, seconds = BellSchedule.current().resolve()
+        response.cache_expires(seconds)
+        response.cache_control.private = True
         return order
 
+    def _order(self):
+        """
+        Return lesson order given in the ``order`` param or the current one.
+
+        """
+        if 'order' not in request.params:
+            return self.current_order()
+        try:
+            return int(request.params['order'])
+        except ValueError:
+            abort(400)
+
+    def _lesson(self, table, person, order):
+        """
+        Return person's lessons at the order.
+
+        Today's scheduled lessons are taken from the :class:`NowTable`.
+        When the ``date`` param is given, lessons which take place on that
+        date (substitutions applied) are taken from the
+        :class:`DateTimetable`.
+
+        """
+        date = self._date_param()
+        if date is None:
+            today = datetime.weekday(datetime.today())
+            return table.lesson(person.id, today, order)
+
+        timetable = DateTimetable.get(date)
+        if person.is_educator:
+            return timetable.teacher_lessons(person.id, date.weekday(), order)
+        return timetable.student_lessons(person.id, order)
+
     def now(self, surname):
         """
         Get the lesson for given person ``surname``.
 
         """
-        current_order = self.current_order()
+        current_order = self._order()
         c.lesson = None
         if current_order is None:
             return render('now/now.xml')
 
-        today = datetime.weekday(datetime.today())
-        schedule = Schedule.current()
+        table = NowTable.current()
 
-        c.year = schedule.year
+        c.year = ScheduleVersion.current().year
 
-        students = Session.query(Student).\
-                filter(Student.last_name.like(surname)).all()
-        teachers = Session.query(Educator).\
-                filter(Educator.last_name.like(surname)).all()
-        people = students + teachers
+        people = table.people(surname)
 
         if len(people) != 1:
             c.people = people
+            c.params = dict((k, request.params[k]) for k in ('date', 'order')
+                            if k in request.params)
             return render('now/list.xml')
 
-        c.lesson = people[0].lesson(today, current_order, schedule.id)
+        c.lesson = self._lesson(table, people[0], current_order)
         return render('now/now.xml')
 
     def now_id(self, id):
@@ -85,18 +111,17 @@ class NowController(BaseController):
         Get the lesson for given person ``id``.
 
         """
-        current_order = self.current_order()
+        current_order = self._order()
         if current_order is None:
             c.lesson = None
             return render('now/now.xml')
 
-        today = datetime.weekday(datetime.today())
-        schedule = Schedule.current()
-        c.year = schedule.year
+        table = NowTable.current()
+        c.year = ScheduleVersion.current().year
 
-        person = Session.query(Student).get(id)
-        if not person:
-            person = Session.query(Educator).get(id)
+        person = table.person(int(id))
+        if person is None:
+            abort(404)
 
-        c.lesson = person.lesson(today, current_order, schedule.id)
+        c.lesson = self._lesson(table, person, current_order)
         return render('now/now.xml')
@@ -14,10 +14,13 @@ from pylons.controllers.util import abort, redirect
 from sqlalchemy import desc
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
+from repoze.what.predicates import not_anonymous
+from repoze.what.plugins.pylonshq import ActionProtector
+
 from sis.lib.base import BaseController, render
 
-from sis.model import Educator, Group, SchoolYear, Schedule
-from sis.model.meta import Session
+from sis.model import Educator, Group, SchoolYear, Schedule, Timetable, \
+                      Occupancy
 
 
 class ScheduleController(BaseController):
@@ -114,17 +117,23 @@ class ScheduleController(BaseController):
         """
         Render teacher's schedule for the given day.
 
+        Lessons which take place on the date given in the ``date``
+        param (substitutions applied) are rendered instead, if present.
+
         :param teacher_name: Surname of the teacher
         :param day_name: Name of the day
 
         """
-        day = self._translate_weekday(day_name)
+        date = self._date_param()
+        if date is not None:
+            day = date.weekday()
+        else:
+            day = self._translate_weekday(day_name)
         if day is None:
             return 'Bad day!'
 
         try:
-            teacher = Session.query(Educator).\
-                    filter(Educator.last_name.like(teacher_name)).one()
+            teacher = Educator.query_search(teacher_name).one()
         except MultipleResultsFound:
             # TODO: how to do that properly?
             return """Hey, too much teachers with given surname were found.
@@ -135,7 +144,11 @@ class ScheduleController(BaseController):
         schedule = Schedule.current()
         c.teacher = teacher
         c.year = schedule.year
-        c.lessons = teacher.schedule_for_day(day, schedule.id)
+        c.date = date
+        if date is not None:
+            c.lessons = teacher.schedule_for_date(date, schedule.id)
+        else:
+            c.lessons = teacher.schedule_for_day(day, schedule.id)
         return render('schedule/teacher.xml')
 
     def group(self, group_name, day_name=None, course_name=None):
@@ -146,6 +159,9 @@ class ScheduleController(BaseController):
         :param day_name: Name of the day
         :param course_name: Optional couse name
 
+        Lessons which take place on the date given in the ``date``
+        param (substitutions applied) are rendered instead, if present.
+
         """
         schedule = Schedule.current()
         year = schedule.year
@@ -155,11 +171,20 @@ class ScheduleController(BaseController):
             c.group_name = group_name
             return render('schedule/group/not_found.xml')
 
-        day = self._translate_weekday(day_name)
+        date = self._date_param()
+        if date is not None:
+            day = date.weekday()
+        else:
+            day = self._translate_weekday(day_name)
         if day is None:
             return 'Bad day!'
 
-        gs = group.schedule_for_day(day, schedule.id)
+        def schedule_of(group):
+            if date is not None:
+                return group.schedule_for_date(date, schedule.id)
+            return group.schedule_for_day(day, schedule.id)
+
+        gs = schedule_of(group)
 
         if course_name is not None:
             course_full_name = group_name[0] + course_name
@@ -168,7 +193,7 @@ class ScheduleController(BaseController):
                 c.group_name = course_full_name
                 return render('schedule/group/not_found.xml')
             else:
-                cs = course.schedule_for_day(day, schedule.id)
+                cs = schedule_of(course)
                 for o, lesson in enumerate(cs):
                     while len(gs) < o + 1:
                         gs.append(None)
@@ -181,6 +206,7 @@ class ScheduleController(BaseController):
 
         c.group = group
         c.year = year
+        c.date = date
         c.lessons = gs
         return render('schedule/group.xml')
 
@@ -241,8 +267,7 @@ class ScheduleController(BaseController):
         :param teacher_name: Last name of the teacher
 
         """
-        teachers = Session.query(Educator).\
-                           filter(Educator.last_name.like(teacher_name)).all()
+        teachers = Educator.query_search(teacher_name).all()
 
         if len(teachers) != 1:
             c.teachers = teachers
@@ -262,15 +287,8 @@ class ScheduleController(BaseController):
 
         """
         schedule = Schedule.current()
-        q = Educator.query_active(schedule_id=schedule.id).\
-                     order_by(Educator.last_name)
-        educators = []
-        for e in q.all():
-            s = e.schedule()
-            educators.append((e, s))
-
         c.year = schedule.year
-        c.educators = educators
+        c.educators = Educator.schedules_for(schedule.id)
         return render('schedule/teacher/full_table.xml')
 
     @beaker_cache(expire=86400)
@@ -281,15 +299,107 @@ class ScheduleController(BaseController):
 
         """
         schedule = Schedule.current()
-        q = Group.query_active(schedule_id=schedule.id).\
-                  join((SchoolYear, Group.year_id == SchoolYear.id)).\
-                  order_by(desc(SchoolYear.start), Group.name)
+        c.year = schedule.year
+        c.groups = Group.schedules_for(schedule.id)
+        return render('schedule/group/full_table.xml')
 
-        groups = []
-        for g in q.all():
-            s = g.schedule(schedule.id)
-            groups.append((g, s))
+    @ActionProtector(not_anonymous())
+    def conflicts(self):
+        """
+        Render room, teacher and group conflicts of the current schedule.
 
+        Rooms given in ``exclude`` param (gym, ie. 100, by default)
+        may hold many lessons at once.
+
+        """
+        exclude = request.params.getall('exclude') or [100]
+        try:
+            exclude = [int(room) for room in exclude]
+        except ValueError:
+            abort(400)
+
+        schedule = Schedule.current()
         c.year = schedule.year
-        c.groups = groups
-        return render('schedule/group/full_table.xml')
+        c.exclude = exclude
+        c.conflicts = schedule.conflicts(exclude_rooms=exclude)
+        return render('schedule/conflicts.xml')
+
+    def free_rooms(self):
+        """
+        Render rooms free on the ``day`` (short name, today by default)
+        from the ``order`` until the ``to`` order (the same by default).
+
+        Rooms given in ``exclude`` param are never listed.
+
+        """
+        day = self._translate_weekday(request.params.get('day') or None)
+        if day is None or day > 4:
+            return 'Bad day!'
+        try:
+            order = int(request.params.get('order', 1))
+            last = int(request.params.get('to') or order)
+            exclude = [int(room) for room in request.params.getall('exclude')]
+        except ValueError:
+            abort(400)
+        if not 0 < order <= last:
+            abort(400)
+
+        schedule = Schedule.current()
+        c.day = day
+        c.order = order
+        c.to = last
+        c.rooms = Occupancy.get(schedule.id).free_rooms(
+                [(day, o) for o in range(order, last + 1)], exclude)
+        return render('schedule/rooms_free.xml')
+
+    def room(self, room):
+        """
+        Render room's weekly schedule.
+
+        :param room: Number of the room
+
+        """
+        schedule = Schedule.current()
+        c.year = schedule.year
+        c.room = int(room)
+        c.schedule = Timetable.get(schedule.id).room_schedule(c.room)
+        return render('schedule/room.xml')
+
+    def free_periods(self):
+        """
+        Render periods in which all given groups and teachers are free.
+
+        Groups are given in ``group`` params as full names, optionally
+        with the part after a slash (eg. "2inf/1"), teachers in ``teacher``
+        params as last names.
+
+        """
+        schedule = Schedule.current()
+        c.year = schedule.year
+        c.errors = []
+
+        groups = []
+        c.groups = [name for name in request.params.getall('group') if name]
+        for name in c.groups:
+            full_name, _, part = name.partition('/')
+            group = Group.by_full_name(full_name)
+            if group is None or part not in ('', '1', '2'):
+                c.errors.append(name)
+            else:
+                groups.append((group.id, part and int(part) or None))
+
+        teachers = []
+        c.teachers = [name for name in request.params.getall('teacher')
+                      if name]
+        for name in c.teachers:
+            found = Educator.query_search(name).all()
+            if len(found) != 1:
+                c.errors.append(name)
+            else:
+                teachers.append(found[0].id)
+
+        c.periods = None
+        if not c.errors and (groups or teachers):
+            occupancy = Occupancy.get(schedule.id)
+            c.periods = occupancy.free_periods(groups, teachers)
+        return render('schedule/free.xml')
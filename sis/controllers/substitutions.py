@@ -2,6 +2,7 @@ import logging
 
 from pylons import request, response, session, tmpl_context as c, url
 from pylons.controllers.util import abort, redirect
+from pylons.decorators import jsonify
 
 from repoze.what.predicates import not_anonymous
 from repoze.what.plugins.pylonshq import ActionProtector
@@ -10,12 +11,16 @@ from sis.lib.base import BaseController, render
 
 log = logging.getLogger(__name__)
 
+import csv
 import datetime
+from cStringIO import StringIO
 
-from sqlalchemy import desc, not_, and_
+from sqlalchemy import desc
+from sqlalchemy.orm import eagerload
 
 from sis.model.meta import Session
-from sis.model import Substitution, Educator, Group, SchoolYear
+from sis.model import Substitution, SubstitutionTable, SubstitutionWeek, \
+                      Educator, Group, SchoolYear, Occupancy
 
 class SubstitutionsController(BaseController):
     """
@@ -27,12 +32,114 @@ class SubstitutionsController(BaseController):
 
     """
 
+    # Number of substitutions listed on one page
+    page_size = 50
+
     def index(self, format='html'):
-        """GET /substitutions: All items in the collection"""
+        """GET /substitutions: All items in the collection
+
+        Substitutions between the ``since`` (today by default) and ``until``
+        dates are listed page by page, each page starts after the ``after``
+        key (see :meth:`sis.model.Substitution.query_range`).
+
+        ``/substitutions.csv`` streams all substitutions in the range
+        (the whole history by default).
+
+        """
         # url('substitutions')
-        c.subs = Session.query(Substitution).order_by(Substitution.date).all()
+        since = self._date_param('since')
+        until = self._date_param('until')
+        if format == 'csv':
+            return self._export(since, until)
+        elif format != 'html':
+            abort(404)
+
+        if since is None:
+            since = datetime.date.today()
+        after = self._key_param('after')
+
+        q = Substitution.query_range(since, until, after).\
+                options(eagerload('group'), eagerload('teacher'))
+        subs = q.limit(self.page_size + 1).all()
+
+        c.next = None
+        if len(subs) > self.page_size:
+            subs = subs[:self.page_size]
+            c.next = self._format_key(subs[-1].key)
+        c.subs = subs
+        c.since = since
+        c.until = until
+        c.range = dict(since=since.isoformat())
+        if until is not None:
+            c.range['until'] = until.isoformat()
         return render('substitutions/list.xml')
 
+    def _format_key(self, key):
+        date, order, id = key
+        return "%s,%d,%d" % (date.isoformat(), order, id)
+
+    def _key_param(self, name):
+        """
+        Return (date, order, id) key given in the request's ``name`` param
+        or None if there is no such param.
+
+        """
+        value = request.params.get(name)
+        if not value:
+            return None
+        try:
+            date, order, id = value.split(',')
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            return date, int(order), int(id)
+        except ValueError:
+            abort(400)
+
+    def _export(self, since=None, until=None):
+        """
+        Stream substitutions as CSV.
+
+        """
+        response.content_type = 'text/csv'
+        response.charset = 'utf-8'
+        response.headers['Content-Disposition'] = \
+                'attachment; filename=substitutions.csv'
+        return self._export_rows(since, until)
+
+    def _export_rows(self, since, until, chunk_size=16384):
+        """
+        Generate CSV data in chunks.
+
+        Substitutions are read in batches using a private session, because
+        the response is sent after the request's session has been removed.
+
+        """
+        db = Session.session_factory()
+        try:
+            q = Substitution.query_range(since, until,
+                                         q=db.query(Substitution)).\
+                        options(eagerload('group'), eagerload('group.year'),
+                                eagerload('teacher')).\
+                        yield_per(500)
+
+            buf = StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(['date', 'order', 'year', 'group', 'part',
+                             'teacher', 'comment'])
+            for sub in q:
+                teacher = sub.teacher and sub.teacher.name or u''
+                writer.writerow([sub.date.isoformat(), sub.order,
+                                 sub.group.year.start.year,
+                                 sub.group.name.encode('utf-8'),
+                                 sub.part or '', teacher.encode('utf-8'),
+                                 (sub.comment or u'').encode('utf-8')])
+                if buf.tell() >= chunk_size:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            yield buf.getvalue()
+        finally:
+            db.close()
+
     def _closest_working_day(self, date):
         """
         Return closest working day but never the same day!
@@ -52,10 +159,7 @@ class SubstitutionsController(BaseController):
         This action tries to recreate table view as based on
         http://www.staszic.edu.pl/zastepstwa/.
 
-        It gathers following data:
-        1. Which lessons do the group ussually have?
-        2. Which lessons do groups have in substitution?
-        3. Which groups (parts) are released (freed from the lesson)
+        See :class:`sis.model.SubstitutionTable`.
 
         """
         if date is None:
@@ -63,135 +167,46 @@ class SubstitutionsController(BaseController):
         else:
             date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
 
-        # Fetch substitutions from database
-        q = Session.query(Substitution).filter_by(date=date)
-
-        # Filter out pointless substitutions (those, which have both
-        # parts set as False - no part is set)
-        q = q.filter(not_(and_(Substitution.part1 == False,
-                               Substitution.part2 == False)))
-        subs = q.all()
-
-        # Create a dictionary of educators and their lessons by schedule
-        # (before) and the new ones which are substitutes (after).
-        before = {}
-        after = {}
-
-        # Create released groups dict:
-        # keys are lesson orders and value is the list of released groups
-        released = {}
-
-        def fill(d, educator, order, fill):
-            """
-            Helper function for filling the dict.
-
-            It tries to fill as less data as possible so
-            it merges parts intro groups.
-
-            """
-            if not d.has_key(educator):
-                d[educator] = {}
-            e = d[educator]
-            if not e.has_key(order):
-                e[order] = []
-            o = e[order]
-            g = fill[0]
-            p = fill[1]
-
-            if (g, None) in o:
-                # We are trying to append part whereas entire group is present
-                return
-            if p is None:
-                # We are appending entire group, delete "parted" entries
-                for x in [1, 2]:
-                    try:
-                        o.remove((g, x))
-                    except ValueError:
-                        pass
-            o.append(fill)
-
-        def opposite_substituted(subs, sub):
-            """
-            Helper function for checking whether opposite group
-            has been already substituted or the scheduled teacher
-            is having a substituion which stops him from keeping
-            the opposite group.
-
-            It return True when both conditions are met:
-            1. Opposite group doesn't have any substituion on that hour and,
-            2. Scheduled teacher doesn't have any substition with other group.
-
-            """
-            SUBSTITUTED = False
-            EDUCATOR_FREE = True
-            opposite_part = sub.part % 2 + 1
-
-            for s in subs:
-                if s.order != sub.order:
-                    # We want only the same lesson order
-                    continue
-                if s.group == sub.group and s.part == opposite_part:
-                    SUBSTITUTED = True
-                    break
-                if s.teacher == lesson.teacher:
-                    EDUCATOR_FREE = False
-
-            if not SUBSTITUTED and EDUCATOR_FREE:
-                return True
-            else:
-                return False
-
-        class ReleasedGroup(Exception):
-            pass
-
-        # Loop the substitutions
-        for sub in subs:
-            if sub.teacher is None:
-                # Group is released
-                for lesson in sub.group_lesson():
-                    fill(before, lesson.teacher, lesson.order,
-                            (lesson.group, lesson.part))
-                    if sub.part is not None and \
-                            opposite_substituted(subs, sub):
-                        fill(after, lesson.teacher, lesson.order,
-                                (lesson.group, sub.part % 2 + 1))
-                if not released.has_key(sub.order):
-                    released[sub.order] = []
-                released[sub.order].append((sub.group, sub.part))
-                continue
-
-            # What lesson does the group have normally?
-            # And with which educator it is?
-            for lesson in sub.group_lesson():
-                fill(before, lesson.teacher, lesson.order,
-                        (lesson.group, lesson.part))
-                if lesson.part is None and sub.part is not None:
-                    if opposite_substituted(subs, sub):
-                        fill(after, lesson.teacher, lesson.order,
-                                (lesson.group, sub.part % 2 + 1))
-
-            for lesson in sub.teacher_lesson():
-                fill(after, lesson.teacher, lesson.order,
-                        (lesson.group, lesson.part))
-
-            fill(after, sub.teacher, sub.order, (sub.group, sub.part))
-
-        c.debug = ("Substitutions for %s:\nbefore:\t\t%r\nafter:\t\t%r\n" + \
-                 "released:\t%r") % (date, before, after, released)
+        table = SubstitutionTable.for_date(date)
+
+        c.debug = "Substitutions for %s:\n%r" % (date, table)
 
         c.year = SchoolYear.current()
         c.date = date
-        c.before = before
-        c.after = after
-        c.released = released
+        c.table = table
+        c.before = table.before
+        c.after = table.after
+        c.released = table.released
 
         return render('substitutions/table.xml')
 
+    def week(self, date=None):
+        """
+        Create tables of substitutions for the whole week (Monday to
+        Friday) of the date.
+
+        See :class:`sis.model.SubstitutionWeek`.
+
+        """
+        if date is None:
+            date = self._closest_working_day(datetime.datetime.today()).date()
+        else:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+        week = SubstitutionWeek.get(date)
+
+        c.year = SchoolYear.current()
+        c.monday = week.monday
+        c.tables = week.tables
+        return render('substitutions/week.xml')
+
     @ActionProtector(not_anonymous())
     def create(self):
         """POST /substitutions: Create a new item"""
         # url('substitutions')
-        date = datetime.datetime.strptime(request.params['date'], '%Y-%m-%d')
+        date = self._date_param()
+        if date is None:
+            abort(400)
         order = int(request.params['order'])
         group = Session.query(Group).get(int(request.params['group']))
         part = int(request.params['part'])
@@ -219,6 +234,32 @@ class SubstitutionsController(BaseController):
         c.year = SchoolYear.current()
         return render('substitutions/new.xml')
 
+    @ActionProtector(not_anonymous())
+    @jsonify
+    def suggest(self):
+        """
+        GET /substitutions/suggest: Educators free to substitute the group's
+        lesson given by ``date``, ``order``, ``group`` and ``part`` (0 for
+        the entire group) params, best first.
+
+        See :meth:`sis.model.Occupancy.suggest`.
+
+        """
+        date = self._date_param()
+        try:
+            order = int(request.params['order'])
+            group_id = int(request.params['group'])
+            part = int(request.params.get('part', 0)) or None
+        except (KeyError, ValueError):
+            abort(400)
+        if date is None:
+            abort(400)
+
+        suggestions = Occupancy.get().suggest(date, order, group_id, part)
+        return {'educators': [{'id': e.id, 'name': e.name_with_title,
+                               'subject': match, 'load': load}
+                              for e, match, load in suggestions]}
+
     @ActionProtector(not_anonymous())
     def update(self, id):
         """PUT /substitutions/id: Update an existing item"""
@@ -18,3 +18,6 @@ class Globals(object):
 
         """
         self.cache = CacheManager(**parse_cache_config_options(config))
+
+        # The hour that defines the end of the day for lucky numbers
+        self.lucky_change_hour = int(config.get('lucky.change_hour', 15))
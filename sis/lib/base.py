@@ -2,7 +2,11 @@
 
 Provides the BaseController class for subclassing.
 """
+import datetime
+
+from pylons import request
 from pylons.controllers import WSGIController
+from pylons.controllers.util import abort
 from pylons.templating import render_genshi as render
 
 from sis.model import meta
@@ -18,3 +22,18 @@ class BaseController(WSGIController):
             return WSGIController.__call__(self, environ, start_response)
         finally:
             meta.Session.remove()
+
+    def _date_param(self, name='date'):
+        """
+        Return the date given in the request's ``name`` param (as
+        YYYY-MM-DD) or None if there is no such param. Malformed dates
+        are answered with 400.
+
+        """
+        value = request.params.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            abort(400)
@@ -0,0 +1,120 @@
+"""Bulk inserts through SQLAlchemy Core, used by the data import."""
+import time
+import logging
+
+from sqlalchemy import select, func
+
+from sis.model.meta import Base
+
+log = logging.getLogger(__name__)
+
+
+class BulkInsert(object):
+    """
+    Rows inserted with ``executemany`` in a single transaction.
+
+    Rows are queued per table and inserted in batches, parent tables first
+    (in the order of ``Base.metadata.sorted_tables``), so dependent rows
+    may be queued right after the rows they refer to. Primary keys are
+    assigned before inserting (see :meth:`next_id`), which assumes nobody
+    else writes to the tables meanwhile, as is the case during setup.
+
+    Use it as a context manager, the transaction is committed on exit (or
+    rolled back on error) and the rate is logged::
+
+        with BulkInsert(Session.bind, 'subjects') as bulk:
+            id = bulk.add(Subject.__table__, name=name, short=short)
+
+    Mapper extensions are bypassed, so cached data is not invalidated.
+
+    :ivar name: Name of the import stage, used for logging.
+
+    :ivar count: Number of rows added so far.
+    :type count: :class:`int`
+
+    """
+    def __init__(self, bind, name, batch_size=1000):
+        self.bind = bind
+        self.name = name
+        self.batch_size = batch_size
+        self.count = 0
+        self._rows = {}
+        self._queued = 0
+        self._ids = {}
+
+    def __enter__(self):
+        self.connection = self.bind.connect()
+        self.transaction = self.connection.begin()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.flush()
+                self._sync_sequences()
+                self.transaction.commit()
+            else:
+                self.transaction.rollback()
+        finally:
+            self.connection.close()
+
+        if type is None:
+            elapsed = max(time.time() - self.started, 0.001)
+            log.info("%s: %d rows in %.2fs (%d rows/s)." % (self.name,
+                     self.count, elapsed, self.count / elapsed))
+        return False
+
+    def next_id(self, table):
+        """
+        Return next free primary key of the table.
+
+        """
+        if table not in self._ids:
+            last = self.connection.execute(
+                    select([func.max(table.c.id)])).scalar()
+            self._ids[table] = last or 0
+        self._ids[table] += 1
+        return self._ids[table]
+
+    def add(self, table, **row):
+        """
+        Queue the row, assigning its ``id`` if the table has one and it
+        was not given.
+
+        Rows of one table must have the same columns.
+
+        :retval: The row's id or None.
+
+        """
+        if 'id' in table.c and 'id' not in row:
+            row['id'] = self.next_id(table)
+        self._rows.setdefault(table, []).append(row)
+        self.count += 1
+        self._queued += 1
+        if self._queued >= self.batch_size:
+            self.flush()
+        return row.get('id')
+
+    def flush(self):
+        """
+        Insert queued rows.
+
+        """
+        for table in Base.metadata.sorted_tables:
+            rows = self._rows.pop(table, None)
+            if rows:
+                self.connection.execute(table.insert(), rows)
+        self._queued = 0
+
+    def _sync_sequences(self):
+        """
+        Move PostgreSQL's sequences past the assigned ids.
+
+        """
+        if self.connection.dialect.name != 'postgresql':
+            return
+        for table, last in self._ids.items():
+            self.connection.execute(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), %d)"
+                % (table.name, last))
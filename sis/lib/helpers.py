@@ -11,8 +11,7 @@ from pylons import url
 from webhelpers.html.tags import *
 
 from sis.lib.auth.helpers import signed_in
-from sis.model.basic import Schedule
+from sis.model import ScheduleVersion
 
 def schedule_last_update():
-    current = Schedule.current()
-    return current.updated
+    return ScheduleVersion.current().updated
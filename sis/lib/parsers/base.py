@@ -1,5 +1,4 @@
 """Base parsing tools."""
-import types
 from codecs import open
 
 
@@ -9,6 +8,10 @@ class ParserError(Exception):
         self.message = message
         super(ParserError, self).__init__()
 
+    def __reduce__(self):
+        # Errors raised in worker processes are pickled
+        return (self.__class__, (self.message,))
+
     def __repr__(self):
         return "<%s('%s')>" % (self.__class__.__name__, self.message)
 
@@ -32,6 +35,9 @@ class LineError(ParserError):
         self.line = line
         super(LineError, self).__init__(message)
 
+    def __reduce__(self):
+        return (self.__class__, (self.number, self.line, self.message))
+
     def __repr__(self):
         name = self.__class__.__name__
         return "<%s(%d, '%s')>" % (name, self.number, self.message)
@@ -42,31 +48,82 @@ class LineError(ParserError):
 
 
 class Parser(object):
-    """Base parser."""
+    """
+    Base line parser.
+
+    Lines are read one by one from the file and passed (stripped) to
+    ``parse_line(line)``, which subclasses define. Whatever it returns,
+    except None, is yielded when iterating over the parser, so records are
+    produced lazily and only the current line is held in memory.
+
+    :param file: Path to the file, file-like object or any iterable
+                 of lines.
+
+    :param autoload: Whether to parse the whole file right away.
+    :type autoload: bool
+
+    :ivar line_number: Number of the line being parsed (starting with 1).
+    :type line_number: int
+
+    """
     def __init__(self, file, autoload=True, encoding='utf-8'):
-        if type(file) is types.FileType:
-            # Accept normal files
-            self.lines = file.readlines()
-        elif type(file) is types.StringType or \
-             type(file) is types.UnicodeType:
-                 # Open file from string
-                 self.lines = open(file, 'r', encoding).readlines()
-        elif type(file) is types.ListType:
-            # Given lines
+        if isinstance(file, basestring):
+            # Open file from string, when parsing begins
+            self.path = file
+            self.lines = None
+        elif hasattr(file, '__iter__'):
+            # Files, lists of lines, generators...
+            self.path = None
             self.lines = file
         else:
             raise ParserError('Unsupported file type.')
+        self.encoding = encoding
+        self.line_number = 0
 
         if autoload:
             self.parse()
 
+    def read_lines(self):
+        """
+        Generate lines of the file.
+
+        """
+        if self.lines is not None:
+            for line in self.lines:
+                yield line
+            return
+
+        file = open(self.path, 'r', self.encoding)
+        try:
+            for line in file:
+                yield line
+        finally:
+            file.close()
+
+    def feed(self, number, line):
+        """
+        Parse single line of the given number.
+
+        :retval: Parsed record or None.
+
+        """
+        self.line_number = number
+        line = line.strip()
+        try:
+            return self.parse_line(line)
+        except ParserError as e:
+            raise LineError(number, line, e)
+
+    def __iter__(self):
+        for number, line in enumerate(self.read_lines(), 1):
+            record = self.feed(number, line)
+            if record is not None:
+                yield record
+
     def parse(self):
-        for lnr, line in enumerate(self.lines):
-            line = line.strip()
-            try:
-                self.parse_line(line)
-            except ParserError as e:
-                raise LineError(lnr, line, e)
-
-    def parse_line(self, line):
-        raise NotImplementedError()
+        """
+        Parse the whole file.
+
+        """
+        for record in self:
+            pass
@@ -1,14 +1,21 @@
 import re
 import sys
 from calendar import day_abbr
-from codecs import open
 
 from sis.lib.parsers.base import Parser, ParserError
 
-from sis.model import Session, Group, Subject, Lesson, Educator, Schedule
 
 
 class ScheduleParser(Parser):
+    """
+    Base parser of schedule's sections (``#``), weekdays (``@``) and
+    lessons.
+
+    Subclasses define ``redata``, matching lesson lines, and either
+    ``process_data_match(match)``, called with the groups of every match,
+    or their own :meth:`process_data_line`.
+
+    """
     day_names = {
             day_abbr[0].lower() : 0,
             day_abbr[1].lower() : 1,
@@ -22,6 +29,7 @@ class ScheduleParser(Parser):
         self.sections = {}
         self.section = None
         self.day = None
+        self.order = None
         super(ScheduleParser, self).__init__(*args, **kwargs)
 
     def parse_line(self, line):
@@ -59,7 +67,7 @@ class ScheduleParser(Parser):
             raise ParserError(
                     ("Day (%s) was not recognised." + \
                      "Possible values: %r") \
-                    % (day_name, self.day_names)
+                    % (line, self.day_names)
                     )
         # Start lesson order counter
         self.order = 1
@@ -73,9 +81,6 @@ class ScheduleParser(Parser):
         self.process_data_match(m)
         self.order += 1
 
-    def process_data_match(self, match):
-        raise NotImplementedError()
-
 
 class TeacherScheduleParser(ScheduleParser):
     redata = re.compile(r'[123]\w+[123]?[12]?(/[123]\w+[123]?[12]?)*')
@@ -113,9 +118,9 @@ class TeacherScheduleParser(ScheduleParser):
                         % (group_name, group_name + part))
         l = self.lessons[group_name][self.day_number][self.order]
         if part is not None:
-            l[part-1].teacher = teacher
+            l[part-1]['teacher_id'] = teacher
         else:
-            l.teacher = teacher
+            l['teacher_id'] = teacher
 
 
 class ClassScheduleParser(ScheduleParser):
@@ -134,24 +139,27 @@ class ClassScheduleParser(ScheduleParser):
                         (?(sub2none)/-|(?(sub2)/(?P<room2>\w+)))$""",
                         re.UNICODE + re.VERBOSE)
 
-    def __init__(self, schedule, subjects, groups, *args, **kwargs):
-        self.schedule = schedule
+    def __init__(self, schedule_id, subjects, groups, *args, **kwargs):
+        self.schedule_id = schedule_id
         self.subjects = subjects
         self.groups = groups
         super(ClassScheduleParser, self).__init__(*args, **kwargs)
 
     def process_section_line(self, line):
         super(ClassScheduleParser, self).process_section_line(line)
-        self.group = self.groups[self.section_name]
+        self.group_id = self.groups[self.section_name]
 
     def process_lesson(self, sub, room, part=None):
-        sub = self.subjects[sub]
-        teacher = None
+        """
+        Return row of the lesson, its teacher is filled in later by
+        :class:`TeacherScheduleParser`.
+
+        """
         room = room == 'h' and 100 or int(room)
-        l = Lesson(self.schedule, self.group, part, sub,
-                teacher, self.day_number, self.order, room)
-        Session.add(l)
-        return l
+        return dict(schedule_id=self.schedule_id, group_id=self.group_id,
+                    first_part=part != 2, second_part=part != 1,
+                    subject_id=self.subjects[sub], teacher_id=None,
+                    day=self.day_number, order=self.order, room=room)
 
     def process_data_match(self, m):
         if m['sub2'] is None and m['sub2none'] is None:
@@ -171,15 +179,62 @@ class ClassScheduleParser(ScheduleParser):
 
 
 class FullScheduleParser(object):
-    def __init__(self, file, year, groups, subjects, teachers):
-        self.schedule = Schedule(year)
-
-        # Read schedule file and split it respectively
-        d = file.read()
-        c, t = re.search(r'!classes(.*)!teachers(.*)', d, re.DOTALL).groups()
+    """
+    Parser for the schedule file, which consists of the classes' schedule
+    followed by the teachers' one::
+
+        !classes
+        ...
+        !teachers
+        ...
+
+    The file is read line by line and each line is fed to the parser of
+    the current part, so the file is never loaded into memory as a whole.
+    Lessons are parsed into rows of the ``lessons`` table, see
+    :meth:`lessons`.
+
+    :param groups: Ids of the groups keyed by full name.
+    :param subjects: Ids of the subjects keyed by short name.
+    :param teachers: Ids of the educators keyed by last name.
+
+    """
+    markers = ('!classes', '!teachers')
+
+    def __init__(self, file, schedule_id, groups, subjects, teachers):
+        self.schedule_id = schedule_id
+
+        classes = ClassScheduleParser(schedule_id, subjects, groups, [],
+                                      autoload=False)
+        teachers = TeacherScheduleParser(teachers, classes.sections, [],
+                                         autoload=False)
+        parsers = dict(zip(self.markers, (classes, teachers)))
+
+        # Lines before the first marker are ignored
+        parser = None
+        for number, line in enumerate(file, 1):
+            marker = line.strip()
+            if marker in parsers:
+                parser = parsers[marker]
+            elif parser is not None:
+                parser.feed(number, line)
+        if parser is not teachers:
+            raise ParserError('Schedule file must contain both %s and %s '
+                              'parts.' % self.markers)
 
-        # PARSE!
-        classes = ClassScheduleParser(self.schedule, subjects, groups, c.split('\n'))
-        teachers = TeacherScheduleParser(teachers, classes.sections, t.split('\n'))
         self.groups = classes.sections
         self.teachers = teachers.sections
+
+    def lessons(self):
+        """
+        Generate rows of the parsed lessons.
+
+        """
+        for days in self.groups.values():
+            for orders in days.values():
+                for lesson in orders.values():
+                    if isinstance(lesson, tuple):
+                        for part in lesson:
+                            if part is not None:
+                                yield part
+                    else:
+                        yield lesson
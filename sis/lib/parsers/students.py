@@ -29,24 +29,24 @@ class StudentsParser(Parser):
         self._section = None
         self.students = {}
         self.groups = []
+        self.year = None
         super(StudentsParser, self).__init__(*args, **kwargs)
 
-
     def parse(self):
-        # Retrieve schoolyear's start/end dates
-        meta = self.lines.pop(0).strip()
+        super(StudentsParser, self).parse()
+        self.post_parse()
+
+    def process_meta_line(self, line):
+        """Retrieve schoolyear's start/end dates from the first line."""
         try:
-            start_str, end_str = meta[1:].split('-')
-            start = datetime.datetime.strptime(start_str, '%d.%m.%Y')
-            end = datetime.datetime.strptime(end_str, '%d.%m.%Y')
+            start_str, end_str = line[1:].split('-')
+            start = datetime.datetime.strptime(start_str, '%d.%m.%Y').date()
+            end = datetime.datetime.strptime(end_str, '%d.%m.%Y').date()
         except ValueError:
             raise ParserError("""Metadata line is not valid.""")
 
         self.year = SchoolYear(start, end)
 
-        super(StudentsParser, self).parse()
-        self.post_parse()
-
     def post_parse(self):
         # Add students to appropriate group
         # parts (determined by surname's order)
@@ -63,8 +63,37 @@ class StudentsParser(Parser):
                 else:
                     student.part = 2
 
+    def records(self):
+        """
+        Return the parsed file as plain records, free of ORM objects.
+
+        :retval: (year, groups, students, memberships) tuple, where year
+                 is a (start, end) pair, groups are names of the groups,
+                 students are (first name, second name, last name, is male)
+                 tuples and memberships are (student's index, group's name,
+                 part, since) tuples.
+
+        """
+        students = []
+        indexes = {}
+        memberships = []
+        for group_name, members in sorted(self.students.items()):
+            for membership in members:
+                student = membership.student
+                index = indexes.get(id(student))
+                if index is None:
+                    index = indexes[id(student)] = len(students)
+                    students.append((student.first_name, student.second_name,
+                                     student.last_name, student.is_male))
+                memberships.append((index, group_name, membership.part,
+                                    membership.since))
+        year = (self.year.start, self.year.end)
+        return year, [g.name for g in self.groups], students, memberships
+
     def parse_line(self, line):
-        if line.startswith('#'):
+        if self.line_number == 1:
+            self.process_meta_line(line)
+        elif line.startswith('#'):
             self.process_section_line(line[1:])
         elif self.restudent.match(line):
             self.process_data_line(line)
@@ -1,11 +1,11 @@
 """Teachers file parser."""
 import re
 
-from sis.lib.parsers.base import LineError
+from sis.lib.parsers.base import Parser, ParserError
 from sis.model import Educator
 
 
-class TeachersParser(object):
+class TeachersParser(Parser):
     """
     Parser for teachers file.
 
@@ -14,28 +14,31 @@ class TeachersParser(object):
     where ``gender`` is one of two values: "M" or "F",
     for man and woman respectively.
 
+    Educators are yielded one by one while iterating over the parser,
+    empty lines are skipped.
+
     :ivar pattern: Compiled pattern used for parsing
                    (matching) lines from input file.
     :type pattern: _sre.SRE_Pattern
 
-    :ivar lines: Lines of the file
-    :type lines: file-like object
-
     """
     pattern = re.compile(r"""
                           ([.\w-]+)\s # title
                           ([\w-]+)\s # last
                           ([\w-]+)\s # first
-                          (M|F)\s    # gender
+                          (M|F)(?:\s|$) # gender
                           """, re.VERBOSE + re.UNICODE)
-    def __init__(self, lines):
-        self.lines = lines
 
-    def parse_line(self, lnr, line):
+    def __init__(self, file, encoding='utf-8'):
+        super(TeachersParser, self).__init__(file, autoload=False,
+                                             encoding=encoding)
+
+    def parse_line(self, line):
+        if not line:
+            return None
         m = self.pattern.match(line)
         if not m:
-            raise TeachersParserError("Line is not matching: %d. %s" \
-                               % (lnr, line))
+            raise ParserError("Line is not matching")
         title, last, first, gender = m.groups()
 
         if gender == 'M':
@@ -44,18 +47,3 @@ class TeachersParser(object):
             is_male = False
 
         return Educator(title, first, last, is_male)
-
-    def __iter__(self):
-        """
-        Read the :attr:`filename` and parse it.
-
-        Parsing means matching lines for :attr:`pattern` and
-        populating new :class:`sis.model.Educator` objects.
-
-        Raises :class:`TeachersParserError` when line is not matching.
-
-        :retval: :class:`dict` of :class:`sis.model.Educator` objects
-
-        """
-        for lnr, line in enumerate(self.lines):
-            yield self.parse_line(lnr + 1, line)
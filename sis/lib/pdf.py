@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+PDF documents rendering.
+
+Fonts are registered with ReportLab once per process, see
+:func:`register_fonts`.
+
+"""
+import threading
+from cStringIO import StringIO
+
+from pkg_resources import Requirement, resource_filename
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, \
+        PageBreak
+
+_fonts_lock = threading.Lock()
+_fonts_registered = False
+
+
+def register_fonts():
+    """
+    Register Ubuntu fonts with ReportLab, only the first call does it.
+
+    """
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    _fonts_lock.acquire()
+    try:
+        if not _fonts_registered:
+            sis = Requirement.parse("SIS")
+            ubuntu_r = resource_filename(sis, "resources/Ubuntu-R.ttf")
+            ubuntu_b = resource_filename(sis, "resources/Ubuntu-B.ttf")
+            pdfmetrics.registerFont(TTFont('Ubuntu', ubuntu_r))
+            pdfmetrics.registerFont(TTFont('Ubuntu Bold', ubuntu_b))
+            _fonts_registered = True
+    finally:
+        _fonts_lock.release()
+
+
+def _lucky_header_and_footer(canvas, document):
+    canvas.saveState()
+    size = document.pagesize
+    center = size[0] / 2
+
+    canvas.setFont('Ubuntu', 80)
+    canvas.drawCentredString(center,
+        size[1] - document.topMargin / 2, "SZCZĘŚLIWY")
+    canvas.drawCentredString(center, size[1] - document.topMargin + 20,
+                             'NUMEREK')
+
+    canvas.setFont('Ubuntu', 15)
+    canvas.drawRightString(size[0] - document.rightMargin,
+        document.bottomMargin - 20, "Samorząd Uczniowski")
+
+    canvas.restoreState()
+
+
+def lucky_numbers(weeks):
+    """
+    Render lucky numbers for the noticeboard, one page per week.
+
+    The document is rendered in the invariant mode, so the same numbers
+    always give the same bytes.
+
+    :param weeks: Lists of (date, number) pairs.
+
+    :retval: PDF document.
+    :rtype: :class:`str`
+
+    """
+    register_fonts()
+
+    pdf = StringIO()
+    doc = SimpleDocTemplate(pdf, pagesize=A4, topMargin=A4[1]*0.26,
+                            invariant=1)
+    doc.author = 'SIS'
+    doc.title = 'Szczęśliwy numerek'
+
+    style = TableStyle([
+        ('FONT', (0, 0), (0, -1), 'Ubuntu', 80),
+        ('FONT', (1, 0), (1, -1), 'Ubuntu Bold', 80),
+    ])
+    story = []
+    for week in weeks:
+        if story:
+            story.append(PageBreak())
+        data = [('{0} -'.format(date.strftime("%d.%m.%y")), str(number))
+                for date, number in week]
+        table = Table(data)
+        table.setStyle(style)
+        story.append(table)
+
+    doc.build(story, onFirstPage=_lucky_header_and_footer,
+              onLaterPages=_lucky_header_and_footer)
+    return pdf.getvalue()
@@ -3,15 +3,27 @@ from sis.model.meta import Session, Base
 
 from sis.model.basic import Person, Educator, Subject, Group, Lesson, Student, \
         GroupMembership, SchoolYear, Schedule
-from sis.model.subs import Substitution
-from sis.model.lucky import LuckyNumber
+from sis.model.timetable import Timetable, LessonRow
+from sis.model.version import ScheduleVersion, YearIndex
+from sis.model.conflicts import Conflict, ConflictAnalyzer
+from sis.model.membership import MembershipIndex
+from sis.model.now import NowTable, PersonRow
+from sis.model.bells import Bell, BellSchedule
+from sis.model.subs import Substitution, SubstitutionTable, SubstitutionWeek
+from sis.model.overlay import DateTimetable, OverlayRow
+from sis.model.occupancy import Occupancy
+from sis.model.lucky import LuckyNumber, LuckyCycle, LuckyCurrent
 
 from sis.model.auth import AuthUser, AuthGroup, AuthPermission
 
 __all__ = [
     "Session", "Base", "Person", "Educator", "Subject", "Group", "Lesson",
     "Student", "GroupMembership", "SchoolYear", "Schedule", "Substitution",
-    "LuckyNumber", "AuthUser", "AuthGroup", "AuthPermission"
+    "SubstitutionTable", "SubstitutionWeek", "DateTimetable", "OverlayRow",
+    "Occupancy", "LuckyNumber", "LuckyCycle", "LuckyCurrent", "Timetable",
+    "LessonRow", "ScheduleVersion", "YearIndex", "Conflict",
+    "ConflictAnalyzer", "MembershipIndex", "NowTable", "PersonRow", "Bell",
+    "BellSchedule", "AuthUser", "AuthGroup", "AuthPermission"
 ]
 
 def init_model(engine):
@@ -1,17 +1,21 @@
 import datetime
+import unicodedata
 
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy import Column, UniqueConstraint, ForeignKey,\
+from sqlalchemy import Column, UniqueConstraint, ForeignKey, Index,\
                        Integer, Unicode, Boolean, Date
-from sqlalchemy import func, desc, not_, and_
-from sqlalchemy.orm import relation, eagerload
+from sqlalchemy import func, desc
+from sqlalchemy.orm import relation, validates
+from sqlalchemy.orm.attributes import get_history
 
 from sis.model.meta import Base, Session
+from sis.model.caching import CacheExtension
 
 
 class Person(Base):
     """Basic model for representing people."""
     __tablename__ = 'people'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     first_name = Column(Unicode(256), nullable=False)
@@ -19,12 +23,58 @@ class Person(Base):
     last_name = Column(Unicode(256), nullable=False)
     is_male = Column(Boolean, nullable=False)
 
+    # Folded last name (see :meth:`fold`), kept in sync with ``last_name``
+    search_name = Column(Unicode(256), index=True)
+
     def __init__(self, first_name, last_name, is_male=True, second_name=None):
         self.first_name = first_name
         self.second_name = second_name
         self.last_name = last_name
         self.is_male = is_male
 
+    @staticmethod
+    def fold(name):
+        """
+        Lower-case the name and strip its diacritics,
+        eg. u"\u0141\u0105cka" becomes u"lacka".
+
+        """
+        name = unicode(name).lower().replace(u'\u0142', u'l')
+        name = unicodedata.normalize('NFKD', name)
+        return u''.join(ch for ch in name if not unicodedata.combining(ch))
+
+    @validates('last_name')
+    def _sync_search_name(self, key, last_name):
+        self.search_name = self.fold(last_name)
+        return last_name
+
+    @classmethod
+    def query_search(cls, name, prefix=False):
+        """
+        Query people by last name, ignoring case and diacritics.
+
+        Querying :class:`Person` returns both students and educators,
+        along with the educator's id (None for students).
+
+        :param name: Last name or its beginning.
+        :param prefix: Whether to match names starting with ``name``.
+        :type prefix: :class:`bool`
+
+        """
+        name = cls.fold(name)
+        if cls is Person:
+            q = Session.query(Person, Educator.id).\
+                        outerjoin((Educator, Educator.id == Person.id))
+        else:
+            q = Session.query(cls)
+        if prefix:
+            # Range instead of LIKE, so the index is always used
+            q = q.filter(Person.search_name >= name).\
+                  filter(Person.search_name < name + u'\uffff')
+        else:
+            q = q.filter(Person.search_name == name)
+        return q.order_by(Person.search_name)
+
     @property
     def name(self):
         """Get full name (concatenation of first and last names)."""
@@ -52,12 +102,10 @@ class Educator(Person):
         Query educator with lessons in the schedule.
 
         """
-        q = Session.query(cls).outerjoin(Lesson).join(Schedule)
         if schedule_id is None:
-            stmt = Schedule.query_current_id().subquery()
-            q = q.join((stmt, Lesson.schedule_id == stmt.c.id))
-        else:
-            q = q.filter(Schedule.id == schedule_id)
+            schedule_id = Schedule.current_id()
+        q = Session.query(cls).outerjoin(Lesson).join(Schedule).\
+                    filter(Schedule.id == schedule_id)
         return q
 
     @property
@@ -81,20 +129,13 @@ class Educator(Person):
         :param schedule_id: Schedule to work on
         :type schedule_id: :class:`int`
 
-        :param eager: Whether or not eager load lesson's
-                      group and group's year.
+        :param eager: Kept for backwards compatibility, lessons are
+                      always served from the :class:`Timetable` with
+                      group and group's year loaded.
         :type eager: :class`bool`
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.filter(Lesson.day == day).\
-              filter(Lesson.order == order).\
-              filter(Lesson.teacher_id == self.id)
-
-        if eager:
-            q = q.options(eagerload('group'), eagerload('group.year'))
-
-        return q.all()
+        return Timetable.get(schedule_id).teacher_lessons(self.id, day, order)
 
     def lessons_for_day(self, day, schedule_id=None, eager=True):
         """
@@ -106,19 +147,13 @@ class Educator(Person):
         :param schedule_id: Schedule to work on
         :type schedule_id: :class:`int`
 
-        :param eager: Whether or not eager load lesson's
-                      group and group's year.
+        :param eager: Kept for backwards compatibility, lessons are
+                      always served from the :class:`Timetable` with
+                      group and group's year loaded.
         :type eager: :class`bool`
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.filter(Lesson.day == day).\
-              filter(Lesson.teacher_id == self.id)
-
-        if eager:
-            q = q.options(eagerload('group'), eagerload('group.year'))
-
-        return q.all()
+        return Timetable.get(schedule_id).teacher_lessons(self.id, day)
 
     def _process_schedule(self, day):
         """
@@ -143,27 +178,54 @@ class Educator(Person):
         :param schedule_id: Optional schedule's id to work on.
         :type schedule_id: :class:`int`
 
-        :param eager: Whether or not to eagerly load lesson's group
-                      and group's year.
+        :param eager: Kept for backwards compatibility, lessons are
+                      always served from the :class:`Timetable` with
+                      group and group's year loaded.
         :type eager: :class:`bool`
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.filter(Lesson.teacher_id == self.id)
+        lessons = Timetable.get(schedule_id).teacher_lessons(self.id)
+        return self._process_week(lessons)
 
-        if eager:
-            q = q.options(eagerload('group'), eagerload('group.year'))
+    def _process_week(self, lessons):
+        """
+        Returns a schedule for entire week from given (ordered) lessons.
 
+        """
         days = {}
         for x in range(0,5):
             days[x] = []
-        for lesson in q.all():
+        for lesson in lessons:
             days[lesson.day].append(lesson)
         schedule = []
         for day in days.values():
             schedule.append(self._process_schedule(day))
         return schedule
 
+    @classmethod
+    def schedules_for(cls, schedule_id=None):
+        """
+        Get full week schedules of all educators teaching in the schedule.
+
+        All lessons are loaded at once (see :class:`Timetable`), so the
+        cost does not depend on the number of educators.
+
+        :param schedule_id: Optional schedule's id to work on.
+        :type schedule_id: :class:`int`
+
+        :retval: :class:`list` of (educator, schedule) pairs sorted by
+                 educator's last name, where schedule is the same as
+                 returned by :meth:`schedule`.
+
+        """
+        timetable = Timetable.get(schedule_id)
+        educators = sorted(timetable.teachers(), key=lambda e: e.last_name)
+        schedules = []
+        for educator in educators:
+            lessons = timetable.teacher_lessons(educator.id)
+            schedules.append((educator, educator._process_week(lessons)))
+        return schedules
+
     def schedule_for_day(self, day, schedule_id=None):
         """
         Get educator's schedule for given day.
@@ -175,6 +237,19 @@ class Educator(Person):
         lessons = self.lessons_for_day(day, schedule_id, eager=True)
         return self._process_schedule(lessons)
 
+    def schedule_for_date(self, date, schedule_id=None):
+        """
+        Get educator's lessons which take place on the date, ie. with
+        substitutions applied (see :class:`DateTimetable`).
+
+        :param schedule_id: Optional schedule's id to work on.
+        :type schedule_id: :class:`int`
+
+        """
+        lessons = DateTimetable.get(date, schedule_id).\
+                teacher_lessons(self.id)
+        return self._process_schedule(lessons)
+
     def __repr__(self):
         cls = self.__class__.__name__
         return "<%s(%r)>" % (cls, self.name_with_title)
@@ -182,6 +257,7 @@ class Educator(Person):
 
 class Subject(Base):
     __tablename__ = 'subjects'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(128), nullable=False)
@@ -199,6 +275,7 @@ class Subject(Base):
 class SchoolYear(Base):
     """School year."""
     __tablename__ = 'school_years'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     start = Column(Date, nullable=False)
@@ -212,7 +289,7 @@ class SchoolYear(Base):
         self.end = end
 
     @classmethod
-    def query_started(cls, date=None):
+    def query_started(cls, date=None, q=None):
         """
         Query already started years and sort it by date
         from the newest to the oldest.
@@ -223,9 +300,10 @@ class SchoolYear(Base):
         """
         if date is None:
             date = func.date()
-        q = Session.query(SchoolYear).\
-                filter(SchoolYear.start <= date).\
-                order_by(desc(SchoolYear.start))
+        if q is None:
+            q = Session.query(SchoolYear)
+        q = q.filter(SchoolYear.start <= date).\
+              order_by(desc(SchoolYear.start))
         return q
 
     @classmethod
@@ -245,7 +323,12 @@ class SchoolYear(Base):
         """
         Return current year.
 
+        Current year relative to today is served from
+        the :class:`ScheduleVersion` cache.
+
         """
+        if date is None:
+            return ScheduleVersion.current().year
         q = cls.query_started(date)
         return q.first()
 
@@ -254,7 +337,12 @@ class SchoolYear(Base):
         """
         Return a school year for given index.
 
+        Indexes relative to today are served from
+        the :class:`YearIndex` cache.
+
         """
+        if date is None:
+            return YearIndex.current().by_index(index)
         q = cls.query_started(date).\
                 limit(1).offset(index-1)
         return q.first()
@@ -263,7 +351,12 @@ class SchoolYear(Base):
         """
         Return the order in which school year appears back in the history.
 
+        Indexes relative to today are served from
+        the :class:`YearIndex` cache.
+
         """
+        if date is None:
+            return YearIndex.current().index(self)
         q = self.query_started(date).\
                 filter(SchoolYear.start > self.start)
         return q.count() + 1
@@ -279,6 +372,7 @@ class SchoolYear(Base):
 
 class Schedule(Base):
     __tablename__ = 'schedules'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     year_id = Column(ForeignKey('school_years.id'), nullable=False)
@@ -322,6 +416,15 @@ class Schedule(Base):
 
     @classmethod
     def current(cls, year_id=None, date=None, q=None):
+        """
+        Return current active schedule.
+
+        Schedule current as of today is served from
+        the :class:`ScheduleVersion` cache.
+
+        """
+        if year_id is None and date is None and q is None:
+            return ScheduleVersion.current().schedule
         return cls.query_current(year_id, date, q).first()
 
     @classmethod
@@ -331,7 +434,9 @@ class Schedule(Base):
 
     @classmethod
     def current_id(cls, year_id=None, date=None):
-        return cls.query_current_id().first()[0]
+        if year_id is None and date is None:
+            return ScheduleVersion.current().id
+        return cls.query_current_id(year_id, date).first()[0]
 
     def check_rooms(self, exclude=[]):
         """
@@ -341,32 +446,24 @@ class Schedule(Base):
         :param exclude: You can exclude specific room, eg. gym.
         :type excelud: :class:`list` of :class:`int`
 
+        :retval: :class:`list` of lists of lessons sharing the room.
+
         """
-        stmt = Session.query(Lesson.room, Lesson.day, Lesson.order,
-            Lesson.schedule_id)
-        stmt = stmt.group_by(Lesson.room, Lesson.order, Lesson.day, Lesson.schedule_id)
-        stmt = stmt.having(func.count(Lesson.room)>1)
-        stmt = stmt.filter(not_(Lesson.room.in_(exclude)))
-        stmt = stmt.subquery()
-        q = Session.query(Lesson).join((stmt, and_(
-            Lesson.room == stmt.c.room,
-            Lesson.day == stmt.c.day,
-            Lesson.order == stmt.c.order,
-            Lesson.schedule_id == stmt.c.schedule_id)))
-        q = q.order_by(Lesson.day, Lesson.order, Lesson.room)
-
-        conflicts = q.all()
-        if len(conflicts) == 0:
-            return []
-        rooms = [[conflicts.pop(0), conflicts.pop(0)]]
-        for c in conflicts:
-            prev = rooms[-1][-1]
-            if c.room == prev.room and c.day == prev.day and c.order == \
-            prev.order and c.schedule_id == prev.schedule_id:
-                rooms[-1].append(c)
-            else:
-                rooms.append([c])
-        return rooms
+        analyzer = ConflictAnalyzer.for_schedule(self.id, exclude)
+        return [c.lessons for c in analyzer.conflicts(['room'])]
+
+    def conflicts(self, exclude_rooms=[]):
+        """
+        Find all room, teacher and group conflicts in the schedule.
+
+        See :class:`ConflictAnalyzer`.
+
+        :param exclude_rooms: You can exclude specific room, eg. gym.
+        :type exclude_rooms: :class:`list` of :class:`int`
+
+        """
+        analyzer = ConflictAnalyzer.for_schedule(self.id, exclude_rooms)
+        return analyzer.conflicts()
 
     def __repr__(self):
         cls = self.__class__.__name__
@@ -379,6 +476,7 @@ class Group(Base):
             UniqueConstraint('name', 'year_id'),
             {}
             )
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(16), nullable=False)
@@ -398,12 +496,10 @@ class Group(Base):
         Query group with lessons in the schedule.
 
         """
-        q = Session.query(cls).outerjoin(Lesson).join(Schedule)
         if schedule_id is None:
-            stmt = Schedule.query_current_id().subquery()
-            q = q.join((stmt, Lesson.schedule_id == stmt.c.id))
-        else:
-            q = q.filter(Schedule.id == schedule_id)
+            schedule_id = Schedule.current_id()
+        q = Session.query(cls).outerjoin(Lesson).join(Schedule).\
+                    filter(Schedule.id == schedule_id)
         return q
 
     def index(self, year=None):
@@ -415,8 +511,11 @@ class Group(Base):
         """
         if year is not None:
             return year.start.year - self.year.start.year + 1
-        else:
-            return self.year.index()
+        index = YearIndex.current().index_of(self.year_id)
+        if index is None:
+            # Year not started yet
+            index = self.year.index()
+        return index
 
     def full_name(self, year=None):
         """
@@ -432,7 +531,16 @@ class Group(Base):
 
         Full name could be, eg. "1bch", "2inf1" or "2inf2".
 
+        Names relative to today are resolved with
+        the :class:`YearIndex` cache.
+
         """
+        if relative_year is None:
+            group_id = YearIndex.current().group_id(full_name)
+            if group_id is None:
+                return None
+            return Session.query(Group).get(group_id)
+
         if len(full_name) < 1:
             return None
         try:
@@ -451,11 +559,11 @@ class Group(Base):
         Return lesson for specified day and order.
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.filter(Lesson.group_id == self.id).\
-              filter(Lesson.day == day).\
-              filter(Lesson.order == order).first()
-        return q
+        lessons = Timetable.get(schedule_id).\
+                group_lessons(self.id, day, order)
+        if len(lessons) == 0:
+            return None
+        return lessons[0]
 
     def _process_schedule(self, day):
         """
@@ -485,12 +593,18 @@ class Group(Base):
         Get schedule for entire week.
 
         """
-        q = Lesson.query_current(schedule_id)
-        lessons = q.filter(Lesson.group_id == self.id).all()
+        lessons = Timetable.get(schedule_id).group_lessons(self.id)
 
         if len(lessons) == 0:
             return None
 
+        return self._process_week(lessons)
+
+    def _process_week(self, lessons):
+        """
+        Create schedule for entire week from given lessons.
+
+        """
         days = {}
         for x in range(0,5):
             days[x] = []
@@ -502,16 +616,48 @@ class Group(Base):
 
         return schedule
 
+    @classmethod
+    def schedules_for(cls, schedule_id=None):
+        """
+        Get week schedules of all groups having lessons in the schedule.
+
+        All lessons, together with subjects, teachers and groups' years, are
+        loaded at once (see :class:`Timetable`), so the cost does not depend
+        on the number of groups.
+
+        :param schedule_id: Optional schedule's id to work on.
+        :type schedule_id: :class:`int`
+
+        :retval: :class:`list` of (group, schedule) pairs sorted from the
+                 youngest year and by group name, where schedule is the same
+                 as returned by :meth:`schedule`.
+
+        """
+        timetable = Timetable.get(schedule_id)
+        groups = sorted(timetable.groups(),
+                        key=lambda g: (-g.year.start.toordinal(), g.name))
+        schedules = []
+        for group in groups:
+            lessons = timetable.group_lessons(group.id)
+            schedules.append((group, group._process_week(lessons)))
+        return schedules
+
     def schedule_for_day(self, day, schedule_id=None):
         """
         Get schedule for specific day.
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.filter(Lesson.day == day).\
-              filter(Lesson.group_id == self.id)
+        lessons = Timetable.get(schedule_id).group_lessons(self.id, day)
+        return self._process_schedule(lessons)
 
-        return self._process_schedule(q.all())
+    def schedule_for_date(self, date, schedule_id=None):
+        """
+        Get lessons which take place on the date, ie. with substitutions
+        applied (see :class:`DateTimetable`).
+
+        """
+        lessons = DateTimetable.get(date, schedule_id).group_lessons(self.id)
+        return self._process_schedule(lessons)
 
     def __repr__(self):
         cls = self.__class__.__name__
@@ -520,11 +666,12 @@ class Group(Base):
 
 class GroupMembership(Base):
     __tablename__ = 'groups_memberships'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     student_id = Column(ForeignKey('students.id'), primary_key=True)
     student = relation('Student')
 
-    group_id = Column(ForeignKey('groups.id'), primary_key=True)
+    group_id = Column(ForeignKey('groups.id'), primary_key=True, index=True)
     group = relation('Group')
     second_part = Column(Boolean, nullable=False)
 
@@ -549,11 +696,12 @@ class GroupMembership(Base):
 
     @part.setter
     def part(self, part):
-        if self.part == 1:
+        if part == 1:
             self.second_part = False
-        elif self.part == 2:
+        elif part == 2:
             self.second_part = True
-        else:
+        elif part is not None:
+            # None means the part is not known yet (see StudentsParser)
             raise ValueError
 
     def full_group_name(self):
@@ -576,24 +724,25 @@ class Student(Person):
         """
         Get scheduled lesson for specified day and order.
 
+        Only lessons of the student's part of the group (or of the entire
+        group) are returned. Memberships are taken from the
+        :class:`MembershipIndex`, lessons from the :class:`Timetable`.
+
         :param schedule_id: Optional schedule's id to work on.
         :type schedule_id: :class:`int`
 
-        :param eager: Whether or not to load eagerly lesson's group
-                      and group's year.
+        :param eager: Kept for backwards compatibility, lessons are
+                      always served from the :class:`Timetable` with
+                      group and group's year loaded.
 
         """
-        q = Lesson.query_current(schedule_id)
-        q = q.join((Group, Lesson.group_id == Group.id)).\
-              join((GroupMembership, Group.id == GroupMembership.group_id)).\
-              filter(GroupMembership.student_id == self.id).\
-              filter(GroupMembership.active == True).\
-              filter(Lesson.day == day).\
-              filter(Lesson.order == order)
-
-        if eager:
-            q = q.options(eagerload('group'), eagerload('group.year'))
-        return q.all()
+        timetable = Timetable.get(schedule_id)
+        lessons = []
+        for group_id, part in MembershipIndex.current().groups(self.id):
+            for lesson in timetable.group_lessons(group_id, day, order):
+                if lesson.part is None or lesson.part == part:
+                    lessons.append(lesson)
+        return lessons
 
 
 class Lesson(Base):
@@ -602,6 +751,7 @@ class Lesson(Base):
 
     """
     __tablename__ = 'lessons'
+    __mapper_args__ = {'extension': CacheExtension()}
     __table_args__ = (
         UniqueConstraint(
             'group_id', 'day', 'order', 'schedule_id', 'first_part'
@@ -643,6 +793,15 @@ class Lesson(Base):
         self.order = order
         self.room = room
 
+    def changed_schedules(self):
+        """
+        Return ids of schedules affected by a change of the lesson: its
+        schedule and the previous one, if it was moved.
+
+        """
+        return set([self.schedule_id] +
+                   list(get_history(self, 'schedule_id')[2] or ()))
+
     @classmethod
     def query_current(cls, schedule_id=None):
         """
@@ -651,14 +810,12 @@ class Lesson(Base):
         Order by: day, order, part.
 
         """
+        if schedule_id is None:
+            schedule_id = Schedule.current_id()
         q = Session.query(cls).\
+                    filter_by(schedule_id=schedule_id).\
                     order_by(cls.day, cls.order, desc(cls.first_part),
                              desc(cls.second_part))
-        if schedule_id is None:
-            stmt = Schedule.query_current_id().subquery()
-            q = q.join((stmt, cls.schedule_id == stmt.c.id))
-        else:
-            q = q.filter_by(schedule_id=schedule_id)
         return q
 
 
@@ -722,3 +879,23 @@ class Lesson(Base):
         return "<Lesson('%r', '%s', '%s', '%s', '%s', '%s', '%s', '%s')>" % \
                     (self.schedule, self.group, self.part, self.subject,
                      self.teacher, self.day, self.order, self.room)
+
+
+# Lessons are looked up by schedule and then by teacher, group or room
+# (unique constraints cover only lookups starting with the group).
+Index('ix_lessons_teacher', Lesson.__table__.c.schedule_id,
+      Lesson.__table__.c.teacher_id, Lesson.__table__.c.day,
+      Lesson.__table__.c.order)
+Index('ix_lessons_group', Lesson.__table__.c.schedule_id,
+      Lesson.__table__.c.group_id, Lesson.__table__.c.day)
+Index('ix_lessons_room', Lesson.__table__.c.schedule_id,
+      Lesson.__table__.c.room, Lesson.__table__.c.day,
+      Lesson.__table__.c.order)
+
+
+# Caches used by the models above, they are built on top of the models.
+from sis.model.timetable import Timetable
+from sis.model.version import ScheduleVersion, YearIndex
+from sis.model.conflicts import ConflictAnalyzer
+from sis.model.membership import MembershipIndex
+from sis.model.overlay import DateTimetable
@@ -0,0 +1,159 @@
+"""Bell schedule models."""
+import datetime
+import threading
+from bisect import bisect_right
+
+from sqlalchemy import Column, Integer, Time, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relation
+
+from sis.model.meta import Base, Session
+from sis.model.caching import CacheExtension, watch
+from sis.model.version import DailyCache, ScheduleVersion
+
+
+class Bell(Base):
+    """
+    Lesson's start and end time.
+
+    Bells without ``weekday`` apply to every day of the school ``year``.
+    If there is any bell for the given ``weekday``, bells of that weekday
+    replace the default ones (eg. shortened Fridays).
+
+    :ivar weekday: Weekday (0 is Monday) or None for every day.
+    :ivar order: Lesson order.
+
+    """
+    __tablename__ = 'bells'
+    __table_args__ = (
+        UniqueConstraint('year_id', 'weekday', 'order'),
+        {}
+    )
+    __mapper_args__ = {'extension': CacheExtension()}
+
+    id = Column(Integer, primary_key=True)
+    year_id = Column(ForeignKey('school_years.id'), nullable=False)
+    year = relation('SchoolYear')
+    weekday = Column(Integer, nullable=True)
+    order = Column(Integer, nullable=False)
+    start = Column(Time, nullable=False)
+    end = Column(Time, nullable=False)
+
+    def __init__(self, year, order, start, end, weekday=None):
+        self.year = year
+        self.order = order
+        self.start = start
+        self.end = end
+        self.weekday = weekday
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %d, %s-%s)>" % (cls, self.weekday, self.order,
+                                        self.start, self.end)
+
+
+def _seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+class BellSchedule(DailyCache):
+    """
+    Current school year's bells as sorted arrays, one per weekday.
+
+    A lesson lasts from its start until the next lesson's start (so the
+    break belongs to the preceding lesson), the last one until its end.
+
+    """
+    _lock = threading.Lock()
+
+    # Used when there are no bells for the current year
+    default = [
+        (1, datetime.time(7, 55), datetime.time(8, 40)),
+        (2, datetime.time(8, 55), datetime.time(9, 40)),
+        (3, datetime.time(10, 0), datetime.time(10, 45)),
+        (4, datetime.time(10, 55), datetime.time(11, 40)),
+        (5, datetime.time(12, 0), datetime.time(12, 45)),
+        (6, datetime.time(12, 55), datetime.time(13, 40)),
+        (7, datetime.time(13, 50), datetime.time(14, 45)),
+    ]
+
+    def __init__(self, bells, date):
+        """
+        :param bells: (weekday, order, start, end) tuples.
+
+        """
+        super(BellSchedule, self).__init__(date)
+        days = {}
+        for weekday, order, start, end in bells:
+            days.setdefault(weekday, []).append((order, start, end))
+        if None not in days:
+            days[None] = self.default
+
+        self._days = {}
+        for weekday, bells in days.items():
+            bells = sorted(bells, key=lambda b: b[1])
+            self._days[weekday] = (
+                [_seconds(start) for order, start, end in bells],
+                [order for order, start, end in bells],
+                _seconds(bells[-1][2]))
+
+    @classmethod
+    def load(cls, date):
+        """
+        Load bells of the current school year.
+
+        """
+        year = ScheduleVersion.current().year
+        if year is None:
+            return cls([], date)
+        session = Session.session_factory()
+        try:
+            q = session.query(Bell.weekday, Bell.order, Bell.start, Bell.end).\
+                        filter(Bell.year_id == year.id)
+            bells = q.all()
+        finally:
+            session.close()
+        return cls(bells, date)
+
+    def resolve(self, now=None):
+        """
+        Resolve lesson slot at the given moment.
+
+        :param now: Moment to resolve, current datetime if None.
+        :type now: :class:`datetime.datetime`
+
+        :retval: (current order, next order, seconds until the next
+                 boundary) tuple. Orders are None when there is no current
+                 or next lesson on that day. After the last lesson the next
+                 boundary is midnight.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        starts, orders, end = self._days.get(now.weekday(), self._days[None])
+        t = _seconds(now.time())
+
+        i = bisect_right(starts, t)
+        if i == 0:
+            return None, orders[0], starts[0] - t
+        if t >= end:
+            return None, None, 86400 - t
+        if i < len(starts):
+            return orders[i - 1], orders[i], starts[i] - t
+        return orders[i - 1], None, end - t
+
+    def order(self, now=None):
+        """
+        Return current lesson order or None.
+
+        """
+        return self.resolve(now)[0]
+
+    def seconds_left(self, now=None):
+        """
+        Return number of seconds until the next boundary.
+
+        """
+        return self.resolve(now)[2]
+
+
+watch(Bell, BellSchedule)
@@ -0,0 +1,113 @@
+"""Keeping caches in sync with committed changes of the models."""
+import weakref
+
+from sqlalchemy.orm import MapperExtension, SessionExtension, EXT_CONTINUE, \
+                           object_mapper, object_session
+from sqlalchemy.orm.properties import ColumnProperty
+from sqlalchemy.orm.attributes import get_history, set_committed_value, \
+                                      PASSIVE_NO_INITIALIZE
+
+# Caches registered for model classes, see :func:`watch`
+_caches = {}
+
+# Changes flushed by sessions, applied when they commit
+_pending = weakref.WeakKeyDictionary()
+
+
+def watch(model, *caches):
+    """
+    Notify the caches whenever instances of the model (or of its
+    subclasses) are inserted, updated or deleted.
+
+    Cache modules register their caches when imported. Caches are notified
+    by calling ``cache.changed(instance, deleted)`` once the transaction
+    is committed.
+
+    """
+    registered = _caches.setdefault(model, [])
+    for cache in caches:
+        if cache not in registered:
+            registered.append(cache)
+
+
+def caches_of(cls):
+    """
+    Return caches registered for the class and its bases.
+
+    """
+    caches = []
+    for base in cls.__mro__:
+        for cache in _caches.get(base, ()):
+            if cache not in caches:
+                caches.append(cache)
+    return caches
+
+
+def snapshot(instance):
+    """
+    Return a detached copy of the instance's column attributes.
+
+    The copy has the same attribute history as the instance during the
+    flush, so previous values can still be found with ``get_history``
+    after the instance itself has been expired by the commit.
+
+    """
+    mapper = object_mapper(instance)
+    copy = mapper.class_manager.new_instance()
+    for prop in mapper.iterate_properties:
+        if not isinstance(prop, ColumnProperty):
+            continue
+        added, unchanged, deleted = get_history(instance, prop.key,
+                                                passive=PASSIVE_NO_INITIALIZE)
+        if deleted:
+            set_committed_value(copy, prop.key, deleted[0])
+        if added:
+            setattr(copy, prop.key, added[0])
+        elif unchanged:
+            set_committed_value(copy, prop.key, unchanged[0])
+    return copy
+
+
+class CacheExtension(MapperExtension):
+    """
+    Record inserted, updated or deleted instances of the mapped class for
+    the caches registered with :func:`watch`.
+
+    Changes are only recorded during the flush, caches are notified after
+    the commit (see :class:`CacheSessionExtension`), so they never see
+    changes which are rolled back.
+
+    """
+    def changed(self, instance, deleted=False):
+        caches = caches_of(instance.__class__)
+        if caches:
+            session = object_session(instance)
+            _pending.setdefault(session, []).append(
+                    (caches, snapshot(instance), deleted))
+
+    def after_insert(self, mapper, connection, instance):
+        self.changed(instance)
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        self.changed(instance)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        self.changed(instance, deleted=True)
+        return EXT_CONTINUE
+
+
+class CacheSessionExtension(SessionExtension):
+    """
+    Notify caches of the changes recorded by :class:`CacheExtension` when
+    the session commits, forget them when it rolls back.
+
+    """
+    def after_commit(self, session):
+        for caches, instance, deleted in _pending.pop(session, ()):
+            for cache in caches:
+                cache.changed(instance, deleted)
+
+    def after_rollback(self, session):
+        _pending.pop(session, None)
@@ -0,0 +1,105 @@
+"""Schedule conflicts analysis."""
+from sis.model.timetable import Timetable
+
+
+class Conflict(object):
+    """
+    Lessons clashing with each other at the same day and order.
+
+    :ivar kind: What is double-booked: ``'room'``, ``'teacher'``
+                or ``'group'``.
+    :type kind: :class:`str`
+
+    :ivar key: Room number, teacher's id or group's id respectively.
+
+    :ivar lessons: Clashing lessons.
+    :type lessons: :class:`list` of :class:`sis.model.LessonRow`
+
+    """
+    def __init__(self, kind, key, day, order, lessons):
+        self.kind = kind
+        self.key = key
+        self.day = day
+        self.order = order
+        self.lessons = lessons
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %s, %d, %d, %d lessons)>" % (cls, self.kind,
+                self.key, self.day, self.order, len(self.lessons))
+
+
+class ConflictAnalyzer(object):
+    """
+    Finds room double-bookings, teacher double-bookings and overlapping
+    group parts in one pass over the schedule's lessons.
+
+    Teacher taking two groups at once in the same room is not a conflict
+    (eg. joined language course), it is reported only when the lessons
+    take place in different rooms.
+
+    :ivar exclude_rooms: Rooms which may hold many lessons at once
+                         (eg. gym, which is room 100).
+    :type exclude_rooms: :class:`set` of :class:`int`
+
+    """
+    kinds = ('room', 'teacher', 'group')
+
+    def __init__(self, lessons, exclude_rooms=()):
+        self.lessons = lessons
+        self.exclude_rooms = set(exclude_rooms)
+
+    @classmethod
+    def for_schedule(cls, schedule_id=None, exclude_rooms=()):
+        """
+        Create analyzer for lessons of the schedule (see :class:`Timetable`).
+
+        """
+        lessons = Timetable.get(schedule_id).lessons
+        return cls(lessons, exclude_rooms)
+
+    def conflicts(self, kinds=None):
+        """
+        Return conflicts sorted by day, order, kind and key.
+
+        :param kinds: Kinds of conflicts to look for, all if None.
+        :type kinds: sequence of :class:`str`
+
+        """
+        if kinds is None:
+            kinds = self.kinds
+
+        slots = {}
+        for lesson in self.lessons:
+            slot = (lesson.day, lesson.order)
+            if 'room' in kinds and lesson.room not in self.exclude_rooms:
+                slots.setdefault(slot + (0, lesson.room), []).append(lesson)
+            if 'teacher' in kinds:
+                slots.setdefault(slot + (1, lesson.teacher_id), []).\
+                        append(lesson)
+            if 'group' in kinds:
+                slots.setdefault(slot + (2, lesson.group_id), []).\
+                        append(lesson)
+
+        conflicts = []
+        for key in sorted(slots):
+            lessons = slots[key]
+            if len(lessons) < 2:
+                continue
+            day, order, kind, value = key
+            if kind == 1 and len(set(l.room for l in lessons)) < 2:
+                continue
+            if kind == 2 and not self._parts_overlap(lessons):
+                continue
+            conflicts.append(Conflict(self.kinds[kind], value, day, order,
+                                      lessons))
+        return conflicts
+
+    def _parts_overlap(self, lessons):
+        """
+        Check whether any group's part has more than one lesson.
+
+        """
+        first = len([l for l in lessons if l.first_part])
+        second = len([l for l in lessons if l.second_part])
+        return first > 1 or second > 1
@@ -1,12 +1,15 @@
 """Lucky number models."""
 import datetime
 import random
+import threading
 
 from sqlalchemy import Column, Integer, SmallInteger, Date
 from sqlalchemy import func, desc
 
 from sis.model.meta import Base, Session
-from sis.model import Student, GroupMembership, Group, SchoolYear
+from sis.model.basic import Student, GroupMembership, Group, SchoolYear
+from sis.model.caching import CacheExtension, watch
+from sis.model.version import DailyCache
 
 
 class LuckyNumber(Base):
@@ -21,10 +24,11 @@ class LuckyNumber(Base):
 
     """
     __tablename__ = 'lucky_numbers'
+    __mapper_args__ = {'extension': CacheExtension()}
 
     id = Column(Integer, primary_key=True)
     date = Column(Date, nullable=False, unique=True)
-    number = Column(SmallInteger, nullable=False)
+    number = Column(SmallInteger, nullable=False, index=True)
 
     def __init__(self, date, number):
         self.date = date
@@ -35,7 +39,7 @@ class LuckyNumber(Base):
         return "<%s(%s, %s)>" % (cls, self.date, self.number)
 
     @classmethod
-    def current(cls, change_hour, now=None):
+    def current(cls, change_hour, now=None, q=None):
         """
         Return current lucky number.
 
@@ -49,6 +53,8 @@ class LuckyNumber(Base):
                     is set to None it will use real current datetime.
         :type now: :class:`datetime.datetime` or :class:`NoneType`
 
+        :param q: Optional query to work on.
+
         """
         if now is None:
             now = datetime.datetime.now()
@@ -58,13 +64,14 @@ class LuckyNumber(Base):
         else:
             start_date = now.date()
 
-        lucky = Session.query(cls).\
-                    filter(cls.date >= start_date).\
-                    order_by(cls.date).first()
+        if q is None:
+            q = Session.query(cls)
+        lucky = q.filter(cls.date >= start_date).\
+                  order_by(cls.date).first()
         return lucky
 
     @classmethod
-    def current_week(cls, change_hour, now=None):
+    def current_week(cls, change_hour, now=None, q=None):
         """
         Return ``current week``'s lucky numbers.
 
@@ -79,6 +86,8 @@ class LuckyNumber(Base):
                     None it will use real current datetime.
         :type now: :class:`datetime.datetime` or :class:`NoneType`
 
+        :param q: Optional query to work on.
+
         """
         if now is None:
             now = datetime.datetime.now()
@@ -94,7 +103,9 @@ class LuckyNumber(Base):
         first_week_end = start_date + datetime.timedelta(7)
         second_week_end = start_date + datetime.timedelta(14)
 
-        q = Session.query(cls).filter(cls.date >= start_date)
+        if q is None:
+            q = Session.query(cls)
+        q = q.filter(cls.date >= start_date).order_by(cls.date)
 
         # Optmization. If the ``closest_day`` is 0 it is already new week,
         # no need to query next two weeks, only one.
@@ -138,24 +149,10 @@ class LuckyNumber(Base):
         """
         Get left lucky numbers, not used before, sorted.
 
+        See :class:`LuckyCycle`.
+
         """
-        student_count = func.count(Student.id).label('student_count')
-        recent_years = [sy.id for sy in SchoolYear.recent()]
-        stmt =  Session.query(student_count, Student).\
-                        join(GroupMembership).\
-                        join(Group).group_by(Group.id).\
-                        filter(Group.year_id.in_(recent_years)).subquery()
-        max = Session.query(func.max(stmt.c.student_count)).first()[0]
-        count = Session.query(func.count(LuckyNumber.id)).first()[0]
-        past = Session.query(LuckyNumber.number).\
-                       order_by(desc(LuckyNumber.date)).\
-                       limit(count % max).all()
-
-        all = set(range(1, max + 1))
-        past = set(x[0] for x in past)
-        left = list(all.difference(past))
-        left.sort()
-        return left
+        return LuckyCycle.current().left()
 
     @classmethod
     def draw(cls):
@@ -166,3 +163,219 @@ class LuckyNumber(Base):
         left = cls.left()
         random.shuffle(left)
         return left
+
+
+class LuckyCycle(DailyCache):
+    """
+    State of the lucky numbers' draw cycle.
+
+    Numbers are drawn from 1 to the size of the largest group of recent
+    school years, each one once per cycle. The current cycle consists of
+    the last ``count % max`` numbers, where ``count`` is the number of all
+    lucky numbers drawn so far.
+
+    Newly added lucky numbers are applied to the cycle one by one (see
+    :meth:`changed`), any other change causes the cycle to be loaded
+    again.
+
+    :ivar max: The largest number.
+    :type max: :class:`int`
+
+    :ivar count: Number of all lucky numbers.
+    :type count: :class:`int`
+
+    :ivar used: Numbers used in the current cycle.
+    :type used: :class:`frozenset`
+
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, max, count, used, last_id, last_date, date):
+        super(LuckyCycle, self).__init__(date)
+        self.max = max or 0
+        self.count = count
+        self.used = frozenset(used)
+        self.last_id = last_id
+        self.last_date = last_date
+        self._all = frozenset(range(1, self.max + 1))
+
+    @classmethod
+    def load(cls, date):
+        """
+        Compute the cycle from the lucky numbers and the group sizes.
+
+        """
+        session = Session.session_factory()
+        try:
+            recent_years = [sy.id for sy in SchoolYear.query_started(date,
+                                q=session.query(SchoolYear)).limit(3)]
+            student_count = func.count(Student.id).label('student_count')
+            stmt = session.query(student_count, Student).\
+                           join(GroupMembership).\
+                           join(Group).group_by(Group.id).\
+                           filter(Group.year_id.in_(recent_years)).subquery()
+            max = session.query(func.max(stmt.c.student_count)).first()[0]
+            count, last_id, last_date = session.query(
+                    func.count(LuckyNumber.id), func.max(LuckyNumber.id),
+                    func.max(LuckyNumber.date)).first()
+            used = []
+            if max:
+                used = session.query(LuckyNumber.number).\
+                               order_by(desc(LuckyNumber.date)).\
+                               limit(count % max).all()
+        finally:
+            session.close()
+        return cls(max, count, [x[0] for x in used], last_id, last_date, date)
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        """
+        Apply a newly added lucky number to the current cycle, forget the
+        cycle on any other change (including group memberships).
+
+        """
+        cycle = cls._current
+        if cycle is None:
+            return
+        new = isinstance(instance, LuckyNumber) and not deleted and \
+              instance.id > cycle.last_id and \
+              (cycle.last_date is None or instance.date > cycle.last_date)
+        if not new or not cycle.max:
+            cls.invalidate()
+            return
+        cls._lock.acquire()
+        try:
+            if cls._current is cycle:
+                count = cycle.count + 1
+                if count % cycle.max == 0:
+                    used = ()
+                else:
+                    used = cycle.used | set([instance.number])
+                cls._current = cls(cycle.max, count, used, instance.id,
+                                   instance.date, cycle.date)
+        finally:
+            cls._lock.release()
+
+    def left(self):
+        """
+        Return numbers left in the current cycle, sorted.
+
+        """
+        return sorted(self._all - self.used)
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%d of %d left, %s)>" % (cls, self.max - len(self.used),
+                                           self.max, self.date)
+
+
+class LuckyCurrent(object):
+    """
+    Current lucky number and current week's lucky numbers (see
+    :meth:`LuckyNumber.current` and :meth:`LuckyNumber.current_week`).
+
+    Both can change only when the ``change_hour`` passes or when lucky
+    numbers change, so they are resolved once and shared by all requests
+    until then.
+
+    :ivar expires: The moment the answer stops being valid.
+    :type expires: :class:`datetime.datetime`
+
+    """
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, change_hour, lucky, week, expires):
+        self.change_hour = change_hour
+        self.lucky = lucky
+        self.week = week
+        self.expires = expires
+
+    @staticmethod
+    def next_change(change_hour, now):
+        """
+        Return the first moment after ``now`` when the hour becomes
+        ``change_hour``.
+
+        """
+        change = datetime.datetime.combine(now.date(),
+                                           datetime.time(change_hour))
+        if now >= change:
+            change += datetime.timedelta(1)
+        return change
+
+    @classmethod
+    def load(cls, change_hour, now):
+        """
+        Resolve lucky numbers using a private session, so they can be
+        shared between requests.
+
+        """
+        session = Session.session_factory()
+        try:
+            lucky = LuckyNumber.current(change_hour, now,
+                                        q=session.query(LuckyNumber))
+            week = LuckyNumber.current_week(change_hour, now,
+                                            q=session.query(LuckyNumber))
+        finally:
+            session.close()
+        return cls(change_hour, lucky, week,
+                   cls.next_change(change_hour, now))
+
+    @classmethod
+    def get(cls, change_hour, now=None):
+        """
+        Return the answer valid for now, resolving it when needed.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        cache = cls._current
+        if cache is None or not cache.is_fresh(change_hour, now):
+            cls._lock.acquire()
+            try:
+                cache = cls._current
+                if cache is None or not cache.is_fresh(change_hour, now):
+                    cache = cls._current = cls.load(change_hour, now)
+            finally:
+                cls._lock.release()
+        return cache
+
+    def is_fresh(self, change_hour, now):
+        """
+        Check whether the answer is still valid.
+
+        """
+        return self.change_hour == change_hour and now < self.expires and \
+               now >= self.expires - datetime.timedelta(1)
+
+    def seconds_left(self, now=None):
+        """
+        Return number of seconds the answer stays valid for.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        left = self.expires - now
+        return max(0, left.days * 86400 + left.seconds)
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Forget current answer, so it is resolved again on next use.
+
+        """
+        cls._current = None
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        cls.invalidate()
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %d numbers, %s)>" % (cls, self.lucky, len(self.week),
+                                             self.expires)
+
+
+watch(LuckyNumber, LuckyCycle, LuckyCurrent)
+watch(GroupMembership, LuckyCycle)
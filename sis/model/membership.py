@@ -0,0 +1,94 @@
+"""Students' group memberships index."""
+import threading
+
+from sqlalchemy import or_
+
+from sis.model.meta import Session
+from sis.model.basic import GroupMembership
+from sis.model.version import DailyCache
+from sis.model.caching import watch
+
+
+class MembershipIndex(DailyCache):
+    """
+    Groups (and their parts) students belong to as of the date.
+
+    Membership counts when it is active and the date is between its
+    ``since`` and ``to`` dates. Changed memberships are applied to the
+    index one by one (see :meth:`changed`), there is no need to rebuild it.
+
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, memberships, date):
+        super(MembershipIndex, self).__init__(date)
+        self._students = {}
+        for student_id, group_id, second_part in memberships:
+            groups = self._students.setdefault(student_id, {})
+            groups[group_id] = second_part and 2 or 1
+
+    @classmethod
+    def load(cls, date):
+        """
+        Load memberships valid as of the date.
+
+        """
+        session = Session.session_factory()
+        try:
+            q = session.query(GroupMembership.student_id,
+                              GroupMembership.group_id,
+                              GroupMembership.second_part).\
+                        filter(GroupMembership.active == True).\
+                        filter(GroupMembership.since <= date).\
+                        filter(or_(GroupMembership.to == None,
+                                   GroupMembership.to >= date))
+            memberships = q.all()
+        finally:
+            session.close()
+        return cls(memberships, date)
+
+    @classmethod
+    def changed(cls, membership, deleted=False):
+        """
+        Apply inserted, updated or deleted membership to the current index.
+
+        """
+        index = cls._current
+        if index is None:
+            return
+        cls._lock.acquire()
+        try:
+            # Readers may iterate over the old dict, so replace it
+            groups = dict(index._students.get(membership.student_id, {}))
+            groups.pop(membership.group_id, None)
+            if not deleted and index._valid(membership):
+                groups[membership.group_id] = membership.part
+            index._students[membership.student_id] = groups
+        finally:
+            cls._lock.release()
+
+    def _valid(self, membership):
+        return membership.active and membership.since <= self.date and \
+               (membership.to is None or membership.to >= self.date)
+
+    def students(self):
+        """
+        Return (student's id, (group's id, part) pairs) pairs.
+
+        """
+        return [(s, g.items()) for s, g in self._students.items()]
+
+    def groups(self, student_id):
+        """
+        Return (group's id, part) pairs the student belongs to.
+
+        """
+        return self._students.get(student_id, {}).items()
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%d students, %s)>" % (cls, len(self._students),
+                                          self.date)
+
+
+watch(GroupMembership, MembershipIndex)
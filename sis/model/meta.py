@@ -2,10 +2,13 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from sis.model.caching import CacheSessionExtension
+
 __all__ = ['Base', 'Session']
 
 # SQLAlchemy session manager. Updated by model.init_model()
-Session = scoped_session(sessionmaker())
+# Caches are notified of committed changes (see sis.model.caching)
+Session = scoped_session(sessionmaker(extension=CacheSessionExtension()))
 
 # The declarative Base
 Base = declarative_base()
@@ -0,0 +1,140 @@
+"""Precomputed answers for the Now! pages."""
+import threading
+from bisect import bisect_left
+
+from sis.model.meta import Session
+from sis.model.basic import Person, Educator, GroupMembership
+from sis.model.timetable import Timetable
+from sis.model.version import DailyCache, ScheduleVersion
+from sis.model.membership import MembershipIndex
+from sis.model.caching import watch
+
+
+class PersonRow(object):
+    """
+    Lightweight, read-only projection of :class:`sis.model.Person`.
+
+    """
+    __slots__ = ('id', 'first_name', 'last_name', 'is_educator')
+
+    def __init__(self, id, first_name, last_name, is_educator=False):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.is_educator = is_educator
+
+    name = Person.name
+
+    def __repr__(self):
+        return "<%s('%s')>" % (self.__class__.__name__, self.name)
+
+
+class NowTable(DailyCache):
+    """
+    Lessons of every student and educator keyed by
+    ``(person's id, weekday, order)``, plus people indexed by folded
+    last name (see :meth:`sis.model.Person.fold`).
+
+    The table is built from the current schedule's :class:`Timetable` and
+    the :class:`MembershipIndex`, so it is rebuilt when the day or the
+    current schedule changes and when people or memberships change.
+
+    :ivar schedule_id: Schedule the table was built for.
+    :type schedule_id: :class:`int`
+
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, schedule_id, lessons, people, date):
+        super(NowTable, self).__init__(date)
+        self.schedule_id = schedule_id
+        self._lessons = lessons
+        self._people = dict((p.id, p) for p in people)
+        self._names = {}
+        for person in people:
+            self._names.setdefault(Person.fold(person.last_name), []).\
+                    append(person)
+        # Sorted names for prefix lookups
+        self._sorted = sorted((Person.fold(p.last_name), p.name, p.id, p)
+                              for p in people)
+        self._keys = [entry[0] for entry in self._sorted]
+
+    @classmethod
+    def load(cls, date):
+        """
+        Build the table for the current schedule.
+
+        """
+        schedule_id = ScheduleVersion.current().id
+        timetable = Timetable.get(schedule_id)
+
+        lessons = {}
+        for lesson in timetable.lessons:
+            key = (lesson.teacher_id, lesson.day, lesson.order)
+            lessons.setdefault(key, []).append(lesson)
+        for student_id, groups in MembershipIndex.current().students():
+            for group_id, part in groups:
+                for lesson in timetable.group_lessons(group_id):
+                    if lesson.part is None or lesson.part == part:
+                        key = (student_id, lesson.day, lesson.order)
+                        lessons.setdefault(key, []).append(lesson)
+
+        session = Session.session_factory()
+        try:
+            educators = set(id for (id,) in session.query(Educator.id))
+            q = session.query(Person.id, Person.first_name, Person.last_name)
+            people = [PersonRow(id, first, last, id in educators)
+                      for id, first, last in q]
+        finally:
+            session.close()
+
+        return cls(schedule_id, lessons, people, date)
+
+    def is_fresh(self, today):
+        return super(NowTable, self).is_fresh(today) and \
+               self.schedule_id == ScheduleVersion.current().id
+
+    def lesson(self, person_id, day, order):
+        """
+        Return person's lessons for given day and order.
+
+        """
+        return list(self._lessons.get((person_id, day, order), ()))
+
+    def person(self, person_id):
+        """
+        Return person with given id or None.
+
+        """
+        return self._people.get(person_id)
+
+    def people(self, last_name):
+        """
+        Return people with given last name (ignoring case and diacritics).
+
+        """
+        return list(self._names.get(Person.fold(last_name), ()))
+
+    def complete(self, prefix, limit=10):
+        """
+        Return at most ``limit`` people whose last names start with
+        ``prefix`` (ignoring case and diacritics), sorted by last name.
+
+        """
+        prefix = Person.fold(prefix)
+        people = []
+        i = bisect_left(self._keys, prefix)
+        while i < len(self._keys) and len(people) < limit and \
+                self._keys[i].startswith(prefix):
+            people.append(self._sorted[i][3])
+            i += 1
+        return people
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %d people, %s)>" % (cls, self.schedule_id,
+                                            len(self._people), self.date)
+
+
+watch(Person, NowTable)
+watch(GroupMembership, NowTable)
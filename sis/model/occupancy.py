@@ -0,0 +1,302 @@
+"""Occupancy bitmasks of the schedule's (day, order) slots."""
+import threading
+
+from sis.model.basic import Schedule, Lesson, Group, Educator, Subject
+from sis.model.timetable import Timetable
+from sis.model.overlay import DateTimetable
+from sis.model.caching import watch
+
+# Bits reserved for lessons of one day
+ORDERS = 16
+
+
+def slot(day, order):
+    """
+    Return the bit of the (day, order) slot.
+
+    """
+    return 1 << (day * ORDERS + order - 1)
+
+
+def slots(mask):
+    """
+    Return (day, order) slots set in the mask, ordered by day and order.
+
+    """
+    result = []
+    bit = 0
+    while mask:
+        if mask & 1:
+            result.append((bit // ORDERS, bit % ORDERS + 1))
+        mask >>= 1
+        bit += 1
+    return result
+
+
+def count(mask):
+    """
+    Return number of slots set in the mask.
+
+    """
+    return bin(mask).count('1')
+
+
+class Occupancy(object):
+    """
+    Occupied (day, order) slots of the schedule as bitmasks (see
+    :func:`slot`), so that checking or combining availability is a matter
+    of a few bitwise operations.
+
+    Like :class:`Timetable`, occupancies are built once per schedule and
+    kept until the schedule's timetable changes (see :meth:`changed`).
+
+    :ivar schedule_id: Schedule's id.
+    :type schedule_id: :class:`int`
+
+    :ivar timetable: Timetable the occupancy was built from.
+    :type timetable: :class:`Timetable`
+
+    """
+    _occupancies = {}
+    _lock = threading.Lock()
+
+    def __init__(self, timetable):
+        self.schedule_id = timetable.schedule_id
+        self.timetable = timetable
+        self._educators = {}
+        self._teachers = {}
+        self._subjects = {}
+        self._rooms = {}
+        self._groups = {}
+        self.orders = 0
+        for lesson in timetable.lessons:
+            bit = slot(lesson.day, lesson.order)
+            self.orders = max(self.orders, lesson.order)
+            for part, present in ((1, lesson.first_part),
+                                  (2, lesson.second_part)):
+                if present:
+                    key = (lesson.group_id, part)
+                    self._groups[key] = self._groups.get(key, 0) | bit
+            if lesson.room is not None:
+                self._rooms[lesson.room] = \
+                        self._rooms.get(lesson.room, 0) | bit
+            self._educators[lesson.teacher_id] = lesson.teacher
+            self._teachers[lesson.teacher_id] = \
+                    self._teachers.get(lesson.teacher_id, 0) | bit
+            self._subjects.setdefault(lesson.teacher_id, set()).\
+                    add(lesson.subject_id)
+
+    @classmethod
+    def get(cls, schedule_id=None):
+        """
+        Return occupancy of the schedule, building it on first use.
+
+        :param schedule_id: Schedule to work on, current one if None.
+        :type schedule_id: :class:`int`
+
+        """
+        if schedule_id is None:
+            schedule_id = Schedule.current_id()
+
+        occupancy = cls._occupancies.get(schedule_id)
+        if occupancy is None:
+            cls._lock.acquire()
+            try:
+                occupancy = cls._occupancies.get(schedule_id)
+                if occupancy is None:
+                    occupancy = cls(Timetable.get(schedule_id))
+                    cls._occupancies[schedule_id] = occupancy
+            finally:
+                cls._lock.release()
+        return occupancy
+
+    @classmethod
+    def invalidate(cls, schedule_id=None):
+        """
+        Drop occupancy of the schedule (or all occupancies if None).
+
+        """
+        cls._lock.acquire()
+        try:
+            if schedule_id is None:
+                cls._occupancies.clear()
+            else:
+                cls._occupancies.pop(schedule_id, None)
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        """
+        Drop occupancies whose timetables are dropped, see
+        :meth:`Timetable.changed`.
+
+        """
+        if isinstance(instance, Lesson):
+            for schedule_id in instance.changed_schedules():
+                cls.invalidate(schedule_id)
+        else:
+            cls.invalidate()
+
+    def teacher(self, teacher_id):
+        """
+        Return mask of educator's scheduled lessons.
+
+        """
+        return self._teachers.get(teacher_id, 0)
+
+    def group(self, group_id, part=None):
+        """
+        Return mask of group's lessons, only of the given part if not None.
+
+        """
+        if part is not None:
+            return self._groups.get((group_id, part), 0)
+        return self._groups.get((group_id, 1), 0) | \
+               self._groups.get((group_id, 2), 0)
+
+    def week(self, orders=None):
+        """
+        Return mask of all slots from Monday to Friday up to the order.
+
+        :param orders: The last order, the last one used in the schedule
+                       if None.
+
+        """
+        if orders is None:
+            orders = self.orders
+        day = (1 << orders) - 1
+        mask = 0
+        for i in range(5):
+            mask |= day << (i * ORDERS)
+        return mask
+
+    def free_periods(self, groups=(), teachers=(), orders=None):
+        """
+        Return (day, order) slots in which all the groups and educators
+        are free.
+
+        :param groups: (group's id, part) pairs, part may be None for
+                       the entire group.
+        :param teachers: Educators' ids.
+        :param orders: The last order to consider, the last one used in
+                       the schedule if None.
+
+        """
+        occupied = 0
+        for group_id, part in groups:
+            occupied |= self.group(group_id, part)
+        for teacher_id in teachers:
+            occupied |= self.teacher(teacher_id)
+        return slots(self.week(orders) & ~occupied)
+
+    def room(self, room):
+        """
+        Return mask of lessons held in the room.
+
+        """
+        return self._rooms.get(room, 0)
+
+    def rooms(self):
+        """
+        Return sorted numbers of rooms used in the schedule.
+
+        """
+        return sorted(self._rooms)
+
+    def free_rooms(self, periods, exclude=()):
+        """
+        Return sorted numbers of rooms free at every one of the periods.
+
+        :param periods: (day, order) pairs.
+
+        :param exclude: Rooms which are never free (eg. gym).
+
+        """
+        mask = 0
+        for day, order in periods:
+            mask |= slot(day, order)
+        return sorted(room for room, occupied in self._rooms.items()
+                      if not occupied & mask and room not in exclude)
+
+    def teachers_on(self, date):
+        """
+        Return masks of educators' lessons in the week with substitutions
+        of the date ORed in.
+
+        :retval: (masks, absent) pair of dictionaries keyed by educator's
+                 id, masks of lessons and masks of the educator's lessons
+                 substituted on the date.
+
+        """
+        day = date.weekday()
+        masks = self._teachers
+        absent = {}
+        subs = DateTimetable.get(date, self.schedule_id).substitutions
+        if subs:
+            masks = dict(masks)
+        for sub in subs:
+            for lesson in self._lessons(sub.group_id, day, sub.order,
+                                        sub.part):
+                if lesson.teacher_id != sub.teacher_id:
+                    absent[lesson.teacher_id] = \
+                            absent.get(lesson.teacher_id, 0) | \
+                            slot(day, sub.order)
+            if sub.teacher_id is not None:
+                masks[sub.teacher_id] = masks.get(sub.teacher_id, 0) | \
+                        slot(day, sub.order)
+        return masks, absent
+
+    def suggest(self, date, order, group_id, part=None):
+        """
+        Suggest substitutes for the group's lesson.
+
+        Educators who are free at the order on the date (and whose own
+        lesson at the order is not substituted) are returned. Those teaching
+        the subject of the group's scheduled lesson come first, then the
+        ones with the lowest load.
+
+        :param part: Substituted part of the group, entire group if None.
+
+        :retval: :class:`list` of (educator, subject match, load) tuples,
+                 where load is the number of the educator's occupied slots
+                 in the week.
+
+        """
+        day = date.weekday()
+        bit = slot(day, order)
+        masks, absent = self.teachers_on(date)
+
+        lessons = self._lessons(group_id, day, order, part)
+        subjects = set(l.subject_id for l in lessons)
+        for lesson in lessons:
+            absent[lesson.teacher_id] = absent.get(lesson.teacher_id, 0) | bit
+
+        suggestions = []
+        for teacher_id, educator in self._educators.items():
+            mask = masks.get(teacher_id, 0)
+            if (mask | absent.get(teacher_id, 0)) & bit:
+                continue
+            match = bool(self._subjects[teacher_id] & subjects)
+            suggestions.append((educator, match, count(mask)))
+        suggestions.sort(key=lambda s: (not s[1], s[2], s[0].last_name))
+        return suggestions
+
+    def _lessons(self, group_id, day, order, part=None):
+        """
+        Return group's lessons at the order attended by the part, all of
+        them if part is None.
+
+        """
+        return [l for l in self.timetable.group_lessons(group_id, day, order)
+                if part is None or l.part is None or l.part == part]
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s)>" % (cls, self.schedule_id)
+
+
+watch(Lesson, Occupancy)
+watch(Group, Occupancy)
+watch(Educator, Occupancy)
+watch(Subject, Occupancy)
@@ -0,0 +1,250 @@
+"""Effective timetable for a date (schedule plus substitutions)."""
+import datetime
+import threading
+
+from sqlalchemy import not_, and_
+from sqlalchemy.orm import eagerload
+
+from sis.model.meta import Session
+from sis.model.basic import Schedule
+from sis.model.timetable import Timetable, LessonRow
+from sis.model.membership import MembershipIndex
+from sis.model.subs import Substitution
+from sis.model.caching import watch
+
+
+class OverlayRow(LessonRow):
+    """
+    Lesson changed by a substitution.
+
+    :ivar substitution: Substitution which assigned the teacher or, for
+                        lessons left with only one part of the group,
+                        substitution which took the other part away.
+    :type substitution: :class:`sis.model.Substitution`
+
+    """
+    __slots__ = ('substitution',)
+
+    def __init__(self, *args, **kwargs):
+        self.substitution = kwargs.pop('substitution', None)
+        super(OverlayRow, self).__init__(*args, **kwargs)
+
+
+class DateTimetable(Timetable):
+    """
+    Lessons which actually take place on a date.
+
+    Scheduled lessons of the date's weekday are taken from the
+    schedule's :class:`Timetable`, then substitutions of the date are
+    applied: substituted (or released) parts of the group are removed from
+    the scheduled lessons and substituting teachers get new lessons
+    (:class:`OverlayRow`) with the subject and room of the lesson they
+    take over.
+
+    Lookups work the same way as :class:`Timetable` ones, all lessons
+    have the date's weekday. Timetables are kept per (schedule, date) and
+    dropped whenever a substitution of the date changes.
+
+    :ivar date: Date of the lessons.
+    :type date: :class:`datetime.date`
+
+    :ivar substitutions: Substitutions of the date.
+    :type substitutions: :class:`list` of :class:`sis.model.Substitution`
+
+    """
+    _timetables = {}
+    _lock = threading.Lock()
+
+    # Number of dates kept at once, the oldest ones are dropped first
+    size = 32
+
+    def __init__(self, schedule_id, date, lessons, substitutions):
+        super(DateTimetable, self).__init__(schedule_id, lessons)
+        self.date = date
+        self.substitutions = substitutions
+
+    @classmethod
+    def build(cls, timetable, date, substitutions):
+        """
+        Apply substitutions to the scheduled lessons.
+
+        :param timetable: Timetable of the schedule.
+        :type timetable: :class:`Timetable`
+
+        :param substitutions: Substitutions of the date.
+
+        """
+        day = date.weekday()
+        scheduled = {}
+        for lesson in timetable.lessons:
+            if lesson.day == day:
+                scheduled.setdefault((lesson.order, lesson.group_id), []).\
+                        append(lesson)
+
+        subs = {}
+        for sub in substitutions:
+            if sub.part1 or sub.part2:
+                subs.setdefault((sub.order, sub.group_id), []).append(sub)
+
+        lessons = []
+        for key, group_lessons in scheduled.items():
+            taken = subs.get(key, ())
+            for lesson in group_lessons:
+                lessons.extend(cls._remaining(lesson, taken))
+
+        for key, taken in subs.items():
+            group_lessons = scheduled.get(key, ())
+            for sub in taken:
+                if sub.teacher is not None:
+                    lessons.append(cls._substitute(timetable.schedule_id,
+                                                   day, sub, group_lessons))
+
+        lessons.sort(key=lambda l: (l.order, l.group_id,
+                                    not l.first_part, not l.second_part))
+        return cls(timetable.schedule_id, date, lessons, substitutions)
+
+    @staticmethod
+    def _remaining(lesson, subs):
+        """
+        Return what is left of the scheduled lesson after substitutions.
+
+        """
+        first, second = lesson.first_part, lesson.second_part
+        changed_by = None
+        for sub in subs:
+            if (first and sub.part1) or (second and sub.part2):
+                first = first and not sub.part1
+                second = second and not sub.part2
+                changed_by = sub
+        if changed_by is None:
+            return [lesson]
+        if not (first or second):
+            return []
+        return [OverlayRow(lesson.id, lesson.schedule_id, lesson.group_id,
+                           first, second, lesson.subject_id,
+                           lesson.teacher_id, lesson.day, lesson.order,
+                           lesson.room, group=lesson.group,
+                           subject=lesson.subject, teacher=lesson.teacher,
+                           substitution=changed_by)]
+
+    @staticmethod
+    def _substitute(schedule_id, day, sub, scheduled):
+        """
+        Create substituting teacher's lesson.
+
+        """
+        taken = [l for l in scheduled
+                 if (l.first_part and sub.part1) or
+                    (l.second_part and sub.part2)]
+        subject_id = subject = room = None
+        if taken:
+            subject_id, subject = taken[0].subject_id, taken[0].subject
+            room = taken[0].room
+        return OverlayRow(None, schedule_id, sub.group_id, sub.part1,
+                          sub.part2, subject_id, sub.teacher_id, day,
+                          sub.order, room, group=sub.group, subject=subject,
+                          teacher=sub.teacher, substitution=sub)
+
+    @classmethod
+    def load(cls, date, schedule_id):
+        """
+        Load substitutions of the date and apply them to the schedule.
+
+        """
+        session = Session.session_factory()
+        try:
+            q = session.query(Substitution).filter_by(date=date).\
+                        filter(not_(and_(Substitution.part1 == False,
+                                         Substitution.part2 == False))).\
+                        options(eagerload('group'), eagerload('group.year'),
+                                eagerload('teacher')).\
+                        order_by(Substitution.order, Substitution.id)
+            subs = q.all()
+        finally:
+            session.close()
+        return cls.build(Timetable.get(schedule_id), date, subs)
+
+    @classmethod
+    def get(cls, date=None, schedule_id=None):
+        """
+        Return effective timetable for the date, building it on first use.
+
+        :param date: The date, today if None.
+        :type date: :class:`datetime.date`
+
+        :param schedule_id: Schedule to work on, current one if None.
+        :type schedule_id: :class:`int`
+
+        """
+        if date is None:
+            date = datetime.date.today()
+        if schedule_id is None:
+            schedule_id = Schedule.current_id()
+
+        key = (schedule_id, date)
+        timetable = cls._timetables.get(key)
+        if timetable is None:
+            cls._lock.acquire()
+            try:
+                timetable = cls._timetables.get(key)
+                if timetable is None:
+                    timetable = cls.load(date, schedule_id)
+                    if len(cls._timetables) >= cls.size:
+                        oldest = min(cls._timetables, key=lambda k: k[1])
+                        del cls._timetables[oldest]
+                    cls._timetables[key] = timetable
+            finally:
+                cls._lock.release()
+        return timetable
+
+    @classmethod
+    def invalidate(cls, date=None):
+        """
+        Drop timetables of the date (or all timetables if None).
+
+        """
+        cls._lock.acquire()
+        try:
+            if date is None:
+                cls._timetables.clear()
+            else:
+                for key in [k for k in cls._timetables if k[1] == date]:
+                    del cls._timetables[key]
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def changed(cls, substitution, deleted=False):
+        """
+        Drop timetables of the substitution's date (and of its previous
+        date, if it was moved).
+
+        """
+        for date in substitution.changed_dates():
+            cls.invalidate(date)
+
+    def student_lessons(self, student_id, order=None):
+        """
+        Return student's lessons, optionally only for given order.
+
+        Only lessons of the student's part of the group (or of the entire
+        group) are returned. Memberships are taken from the current
+        :class:`MembershipIndex`.
+
+        """
+        lessons = []
+        for group_id, part in MembershipIndex.current().groups(student_id):
+            for lesson in self._lookup(self._groups, group_id, None, order):
+                if lesson.part is None or lesson.part == part:
+                    lessons.append(lesson)
+        lessons.sort(key=lambda l: l.order)
+        return lessons
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %s, %d lessons, %d substitutions)>" % (cls,
+                self.schedule_id, self.date, len(self.lessons),
+                len(self.substitutions))
+
+
+watch(Substitution, DateTimetable)
@@ -1,12 +1,16 @@
 """Substitution models."""
 import datetime
+import threading
 
 from sqlalchemy import Column, Integer, Date, ForeignKey, Unicode, Boolean, \
-        UniqueConstraint, not_, and_
-from sqlalchemy.orm import relation
+        UniqueConstraint, Index, not_, and_, or_
+from sqlalchemy.orm import relation, eagerload
+from sqlalchemy.orm.attributes import get_history
 
 from sis.model.meta import Base, Session
-from sis.model import Lesson
+from sis.model.basic import Lesson, Schedule
+from sis.model.caching import CacheExtension, watch
+from sis.model.timetable import Timetable
 
 
 class Substitution(Base):
@@ -46,6 +50,9 @@ class Substitution(Base):
         UniqueConstraint('date', 'order', 'group_id', 'part2'),
         {}
     )
+    __mapper_args__ = {
+        'extension': CacheExtension()
+    }
 
     id = Column(Integer, primary_key=True)
     date = Column(Date, nullable=False)
@@ -98,6 +105,22 @@ class Substitution(Base):
         self.teacher = teacher
         self.comment = comment
 
+    def changed_dates(self):
+        """
+        Return dates affected by a change of the substitution: its date
+        and the previous one, if it was moved.
+
+        Datetimes (eg. parsed from the request) are cut to dates, as the
+        caches are keyed by dates.
+
+        """
+        dates = set()
+        for date in [self.date] + list(get_history(self, 'date')[2] or ()):
+            if isinstance(date, datetime.datetime):
+                date = date.date()
+            dates.add(date)
+        return dates
+
     def group_lesson(self):
         """Get group's scheduled lesson."""
         day = datetime.date.weekday(self.date)
@@ -114,8 +137,354 @@ class Substitution(Base):
             day=day, order=self.order, teacher_id=self.teacher.id)
         return query.all()
 
+    @classmethod
+    def query_range(cls, since=None, until=None, after=None, q=None):
+        """
+        Query substitutions ordered by date, order and id.
+
+        The ordering matches the ``ix_substitutions_date`` index, so pages
+        are read straight from the index whatever the history's length.
+
+        :param since: The first date, no limit if None.
+        :type since: :class:`datetime.date`
+
+        :param until: The last date, no limit if None.
+        :type until: :class:`datetime.date`
+
+        :param after: (date, order, id) key of the last substitution
+                      of the previous page (keyset pagination).
+        :type after: :class:`tuple`
+
+        """
+        if q is None:
+            q = Session.query(Substitution)
+        if since is not None:
+            q = q.filter(Substitution.date >= since)
+        if until is not None:
+            q = q.filter(Substitution.date <= until)
+        if after is not None:
+            date, order, id = after
+            q = q.filter(or_(Substitution.date > date,
+                             and_(Substitution.date == date,
+                                  or_(Substitution.order > order,
+                                      and_(Substitution.order == order,
+                                           Substitution.id > id)))))
+        return q.order_by(Substitution.date, Substitution.order,
+                          Substitution.id)
+
+    @property
+    def key(self):
+        """(date, order, id) key used for keyset pagination."""
+        return (self.date, self.order, self.id)
+
     def __repr__(self):
         cls = self.__class__.__name__
-        name = self.group.name + (self.part if self.part else '')
+        name = self.group.name + (str(self.part) if self.part else '')
         return "<%s(%s, %d, %r, %r, comment=%r)>" % (cls, self.date,
             self.order, self.teacher, name, self.comment)
+
+
+# Substitutions are looked up by date (ranges) and listed by date and order.
+Index('ix_substitutions_date', Substitution.__table__.c.date,
+      Substitution.__table__.c.order, Substitution.__table__.c.id)
+
+
+class SubstitutionTable(object):
+    """
+    Table of substitutions for one day.
+
+    Gathers following data:
+    1. Which lessons do the groups usually have (``before``)?
+    2. Which lessons do educators have in substitution (``after``)?
+    3. Which groups (parts) are released (freed from the lesson)?
+
+    ``before`` and ``after`` map educators to dictionaries of lesson orders
+    and lists of (group, part) pairs, ``released`` maps lesson orders to
+    lists of (group, part) pairs.
+
+    Substitutions and lessons are indexed by (order, group) and
+    (order, teacher) up front, so the table is computed in linear time.
+
+    :param subs: Substitutions of the day (with at least one part set).
+    :param lessons: Scheduled lessons for the day's weekday, at least those
+                    at the substitutions' orders.
+
+    """
+    def __init__(self, subs, lessons):
+        self.subs = subs
+        self.before = {}
+        self.after = {}
+        self.released = {}
+
+        # Single instance per educator and group, as they are used as keys
+        self._teachers = {}
+        self._groups = {}
+
+        self._group_lessons = {}
+        self._teacher_lessons = {}
+        for lesson in lessons:
+            self._teacher_lessons.setdefault(
+                (lesson.order, lesson.teacher_id), []).append(lesson)
+            if lesson.first_part or lesson.second_part:
+                self._group_lessons.setdefault(
+                    (lesson.order, lesson.group_id), []).append(lesson)
+
+        self._parts = {}
+        self._substitutes = {}
+        for sub in subs:
+            self._parts.setdefault((sub.order, sub.group_id), set()).\
+                    add(sub.part)
+            self._substitutes.setdefault(sub.order, set()).\
+                    add(sub.teacher_id)
+
+        for sub in subs:
+            self._add(sub)
+
+    @classmethod
+    def for_date(cls, date, schedule_id=None):
+        """
+        Create table for the date.
+
+        Substitutions are fetched with one query, lessons come from
+        the schedule's :class:`Timetable`.
+
+        """
+        q = Session.query(Substitution).filter_by(date=date)
+
+        # Filter out pointless substitutions (those, which have both
+        # parts set as False - no part is set)
+        q = q.filter(not_(and_(Substitution.part1 == False,
+                               Substitution.part2 == False)))
+        q = q.options(eagerload('group'), eagerload('group.year'),
+                      eagerload('teacher'))
+        subs = q.all()
+
+        day = datetime.date.weekday(date)
+        orders = set(sub.order for sub in subs)
+        lessons = [l for l in Timetable.get(schedule_id).lessons
+                   if l.day == day and l.order in orders]
+        return cls(subs, lessons)
+
+    def _teacher(self, teacher):
+        return self._teachers.setdefault(teacher.id, teacher)
+
+    def _group(self, group):
+        return self._groups.setdefault(group.id, group)
+
+    def _fill(self, d, educator, order, fill):
+        """
+        Helper function for filling the dict.
+
+        It tries to fill as less data as possible so
+        it merges parts into groups.
+
+        """
+        o = d.setdefault(self._teacher(educator), {}).setdefault(order, [])
+        g = self._group(fill[0])
+        p = fill[1]
+
+        if (g, None) in o:
+            # We are trying to append part whereas entire group is present
+            return
+        if p is None:
+            # We are appending entire group, delete "parted" entries
+            for x in [1, 2]:
+                try:
+                    o.remove((g, x))
+                except ValueError:
+                    pass
+        o.append((g, p))
+
+    def _opposite_free(self, sub, lesson):
+        """
+        Check whether scheduled educator keeps the opposite part of the
+        group, ie. when both conditions are met:
+        1. Opposite part doesn't have any substitution on that hour and,
+        2. Scheduled educator doesn't have any substitution on that hour.
+
+        """
+        opposite_part = sub.part % 2 + 1
+        parts = self._parts.get((sub.order, sub.group_id), ())
+        substitutes = self._substitutes.get(sub.order, ())
+        return opposite_part not in parts and \
+               lesson.teacher_id not in substitutes
+
+    def _add(self, sub):
+        group_lessons = self._group_lessons.get((sub.order, sub.group_id), ())
+
+        if sub.teacher is None:
+            # Group is released
+            for lesson in group_lessons:
+                self._fill(self.before, lesson.teacher, lesson.order,
+                           (lesson.group, lesson.part))
+                if sub.part is not None and self._opposite_free(sub, lesson):
+                    self._fill(self.after, lesson.teacher, lesson.order,
+                               (lesson.group, sub.part % 2 + 1))
+            self.released.setdefault(sub.order, []).\
+                    append((self._group(sub.group), sub.part))
+            return
+
+        # What lesson does the group have normally?
+        # And with which educator it is?
+        for lesson in group_lessons:
+            self._fill(self.before, lesson.teacher, lesson.order,
+                       (lesson.group, lesson.part))
+            if lesson.part is None and sub.part is not None and \
+                    self._opposite_free(sub, lesson):
+                self._fill(self.after, lesson.teacher, lesson.order,
+                           (lesson.group, sub.part % 2 + 1))
+
+        for lesson in self._teacher_lessons.get((sub.order, sub.teacher_id),
+                                                ()):
+            self._fill(self.after, lesson.teacher, lesson.order,
+                       (lesson.group, lesson.part))
+
+        self._fill(self.after, sub.teacher, sub.order, (sub.group, sub.part))
+
+    def __repr__(self):
+        return ("before:\t\t%r\nafter:\t\t%r\nreleased:\t%r") % \
+               (self.before, self.after, self.released)
+
+
+class SubstitutionWeek(object):
+    """
+    Substitution tables (see :class:`SubstitutionTable`) for every working
+    day of a week.
+
+    Substitutions of the whole week are fetched with one query and
+    lessons of all weekdays are taken from the schedule's
+    :class:`Timetable` in one pass. Weeks are kept per (schedule, Monday)
+    and dropped whenever a substitution of the week changes.
+
+    :ivar monday: The first day of the week.
+    :type monday: :class:`datetime.date`
+
+    :ivar tables: (date, table) pairs from Monday to Friday.
+    :type tables: :class:`list`
+
+    """
+    _weeks = {}
+    _lock = threading.Lock()
+
+    # Number of weeks kept at once, the oldest ones are dropped first
+    size = 16
+
+    def __init__(self, monday, tables):
+        self.monday = monday
+        self.tables = tables
+
+    @staticmethod
+    def monday_of(date):
+        """
+        Return Monday of the date's week.
+
+        """
+        return date - datetime.timedelta(date.weekday())
+
+    @classmethod
+    def build(cls, monday, subs, lessons):
+        """
+        Build tables from substitutions of the week and scheduled lessons.
+
+        :param subs: Substitutions of the week (with at least one part set).
+        :param lessons: Scheduled lessons, at least those of the weekdays
+                        and orders of the substitutions.
+
+        """
+        days = [monday + datetime.timedelta(i) for i in range(5)]
+        day_subs = dict((date, []) for date in days)
+        for sub in subs:
+            day_subs[sub.date].append(sub)
+
+        orders = set((sub.date.weekday(), sub.order) for sub in subs)
+        day_lessons = dict((date.weekday(), []) for date in days)
+        for lesson in lessons:
+            if (lesson.day, lesson.order) in orders:
+                day_lessons[lesson.day].append(lesson)
+
+        tables = [(date, SubstitutionTable(day_subs[date],
+                                           day_lessons[date.weekday()]))
+                  for date in days]
+        return cls(monday, tables)
+
+    @classmethod
+    def load(cls, monday, schedule_id):
+        """
+        Load substitutions of the week using a private session, so they
+        can be shared between requests.
+
+        """
+        session = Session.session_factory()
+        try:
+            q = Substitution.query_range(monday,
+                                         monday + datetime.timedelta(4),
+                                         q=session.query(Substitution)).\
+                        filter(not_(and_(Substitution.part1 == False,
+                                         Substitution.part2 == False))).\
+                        options(eagerload('group'), eagerload('group.year'),
+                                eagerload('teacher'))
+            subs = q.all()
+        finally:
+            session.close()
+        return cls.build(monday, subs, Timetable.get(schedule_id).lessons)
+
+    @classmethod
+    def get(cls, date, schedule_id=None):
+        """
+        Return substitution tables of the date's week.
+
+        :param schedule_id: Schedule to work on, current one if None.
+        :type schedule_id: :class:`int`
+
+        """
+        if schedule_id is None:
+            schedule_id = Schedule.current_id()
+        key = (schedule_id, cls.monday_of(date))
+        week = cls._weeks.get(key)
+        if week is None:
+            cls._lock.acquire()
+            try:
+                week = cls._weeks.get(key)
+                if week is None:
+                    week = cls.load(key[1], schedule_id)
+                    if len(cls._weeks) >= cls.size:
+                        oldest = min(cls._weeks, key=lambda k: k[1])
+                        del cls._weeks[oldest]
+                    cls._weeks[key] = week
+            finally:
+                cls._lock.release()
+        return week
+
+    @classmethod
+    def invalidate(cls, date=None):
+        """
+        Drop tables of the date's week (or all weeks if None).
+
+        """
+        cls._lock.acquire()
+        try:
+            if date is None:
+                cls._weeks.clear()
+            else:
+                monday = cls.monday_of(date)
+                for key in [k for k in cls._weeks if k[1] == monday]:
+                    del cls._weeks[key]
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def changed(cls, substitution, deleted=False):
+        """
+        Drop tables of the substitution's week (and of its previous week,
+        if it was moved).
+
+        """
+        for date in substitution.changed_dates():
+            cls.invalidate(date)
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s)>" % (cls, self.monday)
+
+
+watch(Substitution, SubstitutionWeek)
@@ -0,0 +1,310 @@
+"""In-memory timetable index."""
+import threading
+
+from sqlalchemy import desc
+from sqlalchemy.orm import eagerload
+
+from sis.model.meta import Session
+from sis.model.basic import Lesson, Schedule, Group, Educator, Subject
+from sis.model.caching import watch
+
+
+class LessonRow(object):
+    """
+    Lightweight, read-only projection of :class:`sis.model.Lesson`.
+
+    Rows carry plain column values and references to shared group, subject
+    and teacher objects (one per entity, not per lesson), so templates can
+    use them the same way as lessons, eg. ``lesson.subject.short`` or
+    ``lesson.group.full_name(year)``, without any ORM bookkeeping.
+
+    """
+    __slots__ = ('id', 'schedule_id', 'group_id', 'group', 'first_part',
+                 'second_part', 'subject_id', 'subject', 'teacher_id',
+                 'teacher', 'day', 'order', 'room')
+
+    def __init__(self, id, schedule_id, group_id, first_part, second_part,
+                 subject_id, teacher_id, day, order, room,
+                 group=None, subject=None, teacher=None):
+        self.id = id
+        self.schedule_id = schedule_id
+        self.group_id = group_id
+        self.group = group
+        self.first_part = first_part
+        self.second_part = second_part
+        self.subject_id = subject_id
+        self.subject = subject
+        self.teacher_id = teacher_id
+        self.teacher = teacher
+        self.day = day
+        self.order = order
+        self.room = room
+
+    # Columns needed to create a row, in the order of __init__ arguments
+    columns = (Lesson.id, Lesson.schedule_id, Lesson.group_id,
+               Lesson.first_part, Lesson.second_part, Lesson.subject_id,
+               Lesson.teacher_id, Lesson.day, Lesson.order, Lesson.room)
+
+    part = Lesson.part
+
+    def __cmp__(self, other):
+        """
+        Used for sorting, the same way as :meth:`sis.model.Lesson.__cmp__`.
+
+        """
+        c = cmp(self.day, other.day)
+        if c == 0:
+            c = cmp(self.order, other.order)
+            if c == 0:
+                c = cmp(self.group, other.group)
+                if c == 0:
+                    c = cmp(self.part, other.part)
+        return c
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %s, %s, %s, %s, %s, %s)>" % (cls, self.group,
+                self.part, self.subject, self.teacher, self.day, self.order,
+                self.room)
+
+
+class Timetable(object):
+    """
+    Read-only index of all lessons of one schedule.
+
+    Lessons are loaded once as :class:`LessonRow` objects, together with
+    their groups, groups' years, subjects and teachers, and detached from
+    the session so they can be shared between requests. Timetables are
+    kept by schedule's id until lessons of the schedule change, or any
+    group, educator or subject changes (see :meth:`changed`).
+
+    Every lookup returns a new list of lessons ordered the same way as
+    :meth:`sis.model.Lesson.query_current` orders them, ie. by day, order
+    and part.
+
+    :ivar schedule_id: Indexed schedule's id.
+    :type schedule_id: :class:`int`
+
+    :ivar lessons: All lessons of the schedule.
+    :type lessons: :class:`list` of :class:`LessonRow`
+
+    """
+    _timetables = {}
+    _lock = threading.Lock()
+
+    def __init__(self, schedule_id, lessons):
+        self.schedule_id = schedule_id
+        self.lessons = lessons
+
+        self._groups = self._index('group_id')
+        self._teachers = self._index('teacher_id')
+        self._rooms = self._index('room')
+
+    @classmethod
+    def load(cls, schedule_id):
+        """
+        Load lessons of the schedule and build its timetable.
+
+        Lessons are loaded as plain rows. Their groups (with years),
+        subjects and teachers are loaded with one query per entity type.
+        Everything is loaded using a private session, which is closed
+        afterwards, so that commits in the request's session can never
+        expire the indexed objects.
+
+        """
+        session = Session.session_factory()
+        try:
+            q = session.query(*LessonRow.columns).\
+                        filter(Lesson.schedule_id == schedule_id).\
+                        order_by(Lesson.day, Lesson.order,
+                                 desc(Lesson.first_part),
+                                 desc(Lesson.second_part))
+            rows = q.all()
+
+            group_ids = session.query(Lesson.group_id).\
+                                filter(Lesson.schedule_id == schedule_id)
+            groups = session.query(Group).\
+                             filter(Group.id.in_(group_ids.statement)).\
+                             options(eagerload('year')).all()
+            teacher_ids = session.query(Lesson.teacher_id).\
+                                  filter(Lesson.schedule_id == schedule_id)
+            teachers = session.query(Educator).\
+                    filter(Educator.id.in_(teacher_ids.statement)).all()
+            subjects = session.query(Subject).all()
+        finally:
+            session.close()
+
+        groups = dict((g.id, g) for g in groups)
+        teachers = dict((t.id, t) for t in teachers)
+        subjects = dict((s.id, s) for s in subjects)
+        lessons = []
+        for row in rows:
+            lesson = LessonRow(*row)
+            lesson.group = groups[lesson.group_id]
+            lesson.subject = subjects[lesson.subject_id]
+            lesson.teacher = teachers[lesson.teacher_id]
+            lessons.append(lesson)
+        return cls(schedule_id, lessons)
+
+    @classmethod
+    def get(cls, schedule_id=None):
+        """
+        Return timetable of the schedule, building it on first use.
+
+        :param schedule_id: Schedule to work on, current one if None.
+        :type schedule_id: :class:`int`
+
+        """
+        if schedule_id is None:
+            schedule_id = Schedule.current_id()
+
+        timetable = cls._timetables.get(schedule_id)
+        if timetable is None:
+            cls._lock.acquire()
+            try:
+                timetable = cls._timetables.get(schedule_id)
+                if timetable is None:
+                    timetable = cls.load(schedule_id)
+                    cls._timetables[schedule_id] = timetable
+            finally:
+                cls._lock.release()
+        return timetable
+
+    @classmethod
+    def invalidate(cls, schedule_id=None):
+        """
+        Drop the timetable of the schedule (or all timetables if None),
+        so it is rebuilt on next use.
+
+        """
+        cls._lock.acquire()
+        try:
+            if schedule_id is None:
+                cls._timetables.clear()
+            else:
+                cls._timetables.pop(schedule_id, None)
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        """
+        Drop timetables of the lesson's schedules (see
+        :meth:`sis.model.Lesson.changed_schedules`). Groups, educators and
+        subjects are shared by all timetables, so all of them are dropped
+        when one of those changes.
+
+        """
+        if isinstance(instance, Lesson):
+            for schedule_id in instance.changed_schedules():
+                cls.invalidate(schedule_id)
+        else:
+            cls.invalidate()
+
+    def _index(self, attr):
+        """
+        Index lessons by the ``attr`` value.
+
+        Return a pair of dictionaries: lessons keyed by
+        ``(value, day, order)`` and lessons keyed by ``value`` only.
+
+        """
+        slots = {}
+        week = {}
+        for lesson in self.lessons:
+            key = getattr(lesson, attr)
+            slots.setdefault((key, lesson.day, lesson.order), []).\
+                    append(lesson)
+            week.setdefault(key, []).append(lesson)
+        return slots, week
+
+    def _lookup(self, index, key, day=None, order=None):
+        slots, week = index
+        if day is not None and order is not None:
+            return list(slots.get((key, day, order), ()))
+        lessons = week.get(key, ())
+        if day is not None:
+            return [l for l in lessons if l.day == day]
+        if order is not None:
+            return [l for l in lessons if l.order == order]
+        return list(lessons)
+
+    def teachers(self):
+        """
+        Return educators having any lesson in the schedule.
+
+        """
+        teachers = {}
+        for lesson in self.lessons:
+            teachers[lesson.teacher_id] = lesson.teacher
+        return teachers.values()
+
+    def groups(self):
+        """
+        Return groups having any lesson in the schedule.
+
+        """
+        groups = {}
+        for lesson in self.lessons:
+            groups[lesson.group_id] = lesson.group
+        return groups.values()
+
+    def group_lessons(self, group_id, day=None, order=None):
+        """
+        Return group's lessons, optionally only for given day and order.
+
+        """
+        return self._lookup(self._groups, group_id, day, order)
+
+    def teacher_lessons(self, teacher_id, day=None, order=None):
+        """
+        Return educator's lessons, optionally only for given day and order.
+
+        """
+        return self._lookup(self._teachers, teacher_id, day, order)
+
+    def room_lessons(self, room, day=None, order=None):
+        """
+        Return lessons held in the room, optionally only for given
+        day and order.
+
+        """
+        return self._lookup(self._rooms, room, day, order)
+
+    def rooms(self):
+        """
+        Return sorted numbers of rooms used in the schedule.
+
+        """
+        return sorted(room for room in self._rooms[1] if room is not None)
+
+    def room_schedule(self, room):
+        """
+        Return room's schedule for entire week.
+
+        :retval: :class:`list` of days, each day is a list of lessons'
+                 lists (many groups may share a room, eg. gym) indexed
+                 by lesson order (starting with 0), None when the room
+                 is free.
+
+        """
+        schedule = [[] for day in range(5)]
+        for lesson in self.room_lessons(room):
+            day = schedule[lesson.day]
+            while len(day) < lesson.order:
+                day.append(None)
+            if day[lesson.order - 1] is None:
+                day[lesson.order - 1] = []
+            day[lesson.order - 1].append(lesson)
+        return schedule
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %d lessons)>" % (cls, self.schedule_id,
+                                         len(self.lessons))
+
+
+watch(Lesson, Timetable)
+watch(Group, Timetable)
+watch(Educator, Timetable)
+watch(Subject, Timetable)
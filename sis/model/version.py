@@ -0,0 +1,208 @@
+"""Daily caches of the current schedule and school years."""
+import datetime
+import threading
+
+from sis.model.meta import Session
+from sis.model.basic import Schedule, SchoolYear, Group
+from sis.model.caching import watch
+
+
+class DailyCache(object):
+    """
+    Base for answers which depend only on the date and on rarely changing
+    tables.
+
+    The answer is resolved once and shared by all requests until the day
+    changes or the underlying data changes (see :meth:`changed` and
+    :func:`sis.model.caching.watch`). Subclasses resolve it in their
+    ``load(date)`` class method, which returns the subclass' instance.
+
+    Subclasses load objects using a private session, which is closed
+    afterwards, so they stay detached and are never expired by request's
+    commits.
+
+    :ivar date: Date the answer was resolved for.
+    :type date: :class:`datetime.date`
+
+    """
+    _current = None
+    _lock = None
+
+    def __init__(self, date):
+        self.date = date
+
+    @classmethod
+    def current(cls):
+        """
+        Return current answer, resolving it once a day.
+
+        """
+        today = datetime.date.today()
+        cache = cls._current
+        if cache is None or not cache.is_fresh(today):
+            cls._lock.acquire()
+            try:
+                cache = cls._current
+                if cache is None or not cache.is_fresh(today):
+                    cache = cls._current = cls.load(today)
+            finally:
+                cls._lock.release()
+        return cache
+
+    def is_fresh(self, today):
+        """
+        Check whether the answer is still valid.
+
+        """
+        return self.date == today
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Forget current answer, so it is resolved again on next use.
+
+        """
+        cls._current = None
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        """
+        Called whenever an ``instance`` the answer depends on is inserted,
+        updated or deleted. Forgets current answer by default.
+
+        """
+        cls.invalidate()
+
+
+class ScheduleVersion(DailyCache):
+    """
+    Current schedule, its school year and the date of its last update.
+
+    :ivar schedule: Current schedule, None if there is no such.
+    :type schedule: :class:`sis.model.Schedule`
+
+    :ivar year: Current (most recently started) school year.
+    :type year: :class:`sis.model.SchoolYear`
+
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, schedule, year, date):
+        self.schedule = schedule
+        self.year = year
+        super(ScheduleVersion, self).__init__(date)
+
+    @property
+    def id(self):
+        """Current schedule's id."""
+        if self.schedule is None:
+            return None
+        return self.schedule.id
+
+    @property
+    def updated(self):
+        """Date of the current schedule's last update."""
+        if self.schedule is None:
+            return None
+        return self.schedule.updated
+
+    @classmethod
+    def load(cls, date):
+        """
+        Resolve current schedule and school year.
+
+        """
+        session = Session.session_factory()
+        try:
+            schedule = Schedule.current(q=session.query(Schedule))
+            year = SchoolYear.query_started(q=session.query(SchoolYear)).\
+                              first()
+        finally:
+            session.close()
+        return cls(schedule, year, date)
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%s, %s)>" % (cls, self.id, self.date)
+
+
+class YearIndex(DailyCache):
+    """
+    Order of already started school years and full names of their groups.
+
+    Index 1 is the most recently started year, see
+    :meth:`sis.model.SchoolYear.index`.
+
+    :ivar years: Started school years from the newest to the oldest.
+    :type years: :class:`list` of :class:`sis.model.SchoolYear`
+
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, years, groups, date):
+        self.years = years
+        self._indexes = dict((y.id, i + 1) for i, y in enumerate(years))
+        self._groups = {}
+        for group_id, name, year_id in groups:
+            index = self._indexes.get(year_id)
+            if index is not None:
+                self._groups["%d%s" % (index, name)] = group_id
+        super(YearIndex, self).__init__(date)
+
+    @classmethod
+    def load(cls, date):
+        """
+        Load started school years and names of their groups.
+
+        """
+        session = Session.session_factory()
+        try:
+            years = SchoolYear.query_started(q=session.query(SchoolYear)).\
+                               all()
+            groups = session.query(Group.id, Group.name, Group.year_id).all()
+        finally:
+            session.close()
+        return cls(years, groups, date)
+
+    def index(self, year):
+        """
+        Return the order in which school year appears back in the history.
+
+        """
+        index = self._indexes.get(year.id)
+        if index is None:
+            # Not started yet, count started years which are newer
+            index = len([y for y in self.years if y.start > year.start]) + 1
+        return index
+
+    def index_of(self, year_id):
+        """
+        Return index of the started school year with given id or None.
+
+        """
+        return self._indexes.get(year_id)
+
+    def by_index(self, index):
+        """
+        Return started school year for given index or None.
+
+        """
+        if 0 < index <= len(self.years):
+            return self.years[index - 1]
+        return None
+
+    def group_id(self, full_name):
+        """
+        Return id of the group with given full name (eg. "2inf1") or None.
+
+        """
+        return self._groups.get(full_name)
+
+    def __repr__(self):
+        cls = self.__class__.__name__
+        return "<%s(%d years, %s)>" % (cls, len(self.years), self.date)
+
+
+watch(Schedule, ScheduleVersion)
+watch(SchoolYear, ScheduleVersion, YearIndex)
+watch(Group, YearIndex)
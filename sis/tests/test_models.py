@@ -0,0 +1,772 @@
+import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import get_history
+
+from sis.lib.bulk import BulkInsert
+from sis.model import Session, Base, LessonRow, SubstitutionTable, \
+        SubstitutionWeek, Timetable, DateTimetable, Occupancy, LuckyNumber, \
+        LuckyCycle, LuckyCurrent, Bell, SchoolYear, Student, Group, \
+        GroupMembership, MembershipIndex, BellSchedule, Person, Educator, \
+        Substitution, Schedule, Subject, Lesson
+from sis.model.caching import watch, _caches
+from sis.model.occupancy import slot, slots, count
+
+
+class Entity(object):
+    """Stand-in for educators and groups, compared by identity."""
+    def __init__(self, id, last_name=u''):
+        self.id = id
+        self.last_name = last_name
+
+    def __repr__(self):
+        return "<%s(%d)>" % (self.__class__.__name__, self.id)
+
+
+class Sub(object):
+    """Stand-in for :class:`sis.model.Substitution`."""
+    def __init__(self, order, group, teacher=None, part=None,
+                 date=datetime.date(2010, 3, 15)):
+        self.date = date
+        self.order = order
+        self.group = group
+        self.group_id = group.id
+        self.teacher = teacher
+        self.teacher_id = teacher and teacher.id
+        self.part1 = part != 2
+        self.part2 = part != 1
+        self.part = part
+
+
+class DatabaseTestCase(TestCase):
+    """Test case working on a fresh in-memory SQLite database."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = Session.session_factory(bind=self.engine)
+        # Models' queries go through the scoped session, caches use private
+        # sessions bound through the metadata
+        Session.registry.set(self.session)
+        self.bind, Base.metadata.bind = Base.metadata.bind, self.engine
+
+    def tearDown(self):
+        Base.metadata.bind = self.bind
+        Session.remove()
+        self.engine.dispose()
+
+
+def lesson(group, teacher, order, part=None, room=1, day=0, subject=1):
+    first, second = {None: (True, True), 1: (True, False),
+                     2: (False, True)}[part]
+    return LessonRow(None, 1, group.id, first, second, subject, teacher.id,
+                     day, order, room, group=group, teacher=teacher)
+
+
+class TestSubstitutionTable(TestCase):
+
+    def setUp(self):
+        self.smith, self.jones, self.brown = Entity(1), Entity(2), Entity(3)
+        self.group = Entity(10)
+        self.other = Entity(11)
+
+    def test_released_group(self):
+        lessons = [lesson(self.group, self.smith, 2)]
+        table = SubstitutionTable([Sub(2, self.group)], lessons)
+
+        self.assertEqual(table.before, {self.smith: {2: [(self.group, None)]}})
+        self.assertEqual(table.after, {})
+        self.assertEqual(table.released, {2: [(self.group, None)]})
+
+    def test_substitute_takes_group(self):
+        lessons = [lesson(self.group, self.smith, 3),
+                   lesson(self.other, self.jones, 3, room=2)]
+        table = SubstitutionTable([Sub(3, self.group, self.jones)], lessons)
+
+        self.assertEqual(table.before, {self.smith: {3: [(self.group, None)]}})
+        self.assertEqual(table.after, {
+            self.jones: {3: [(self.other, None), (self.group, None)]}})
+        self.assertEqual(table.released, {})
+
+    def test_opposite_part_kept_by_scheduled_teacher(self):
+        lessons = [lesson(self.group, self.smith, 1)]
+        table = SubstitutionTable([Sub(1, self.group, self.jones, part=1)],
+                                  lessons)
+
+        self.assertEqual(table.after[self.smith], {1: [(self.group, 2)]})
+        self.assertEqual(table.after[self.jones], {1: [(self.group, 1)]})
+
+    def test_opposite_part_substituted_too(self):
+        lessons = [lesson(self.group, self.smith, 1)]
+        subs = [Sub(1, self.group, self.jones, part=1),
+                Sub(1, self.group, self.brown, part=2)]
+        table = SubstitutionTable(subs, lessons)
+
+        self.assertFalse(self.smith in table.after)
+        self.assertEqual(table.after[self.jones], {1: [(self.group, 1)]})
+        self.assertEqual(table.after[self.brown], {1: [(self.group, 2)]})
+
+    def test_entire_group_merges_parts(self):
+        lessons = [lesson(self.group, self.smith, 4, part=1),
+                   lesson(self.group, self.smith, 4, part=2)]
+        table = SubstitutionTable([Sub(4, self.group)], lessons)
+
+        self.assertEqual(table.before, {self.smith: {4: [(self.group, 1),
+                                                         (self.group, 2)]}})
+
+        table._fill(table.before, self.smith, 4, (self.group, None))
+        self.assertEqual(table.before, {self.smith: {4: [(self.group, None)]}})
+
+    def test_lessons_of_other_orders_ignored(self):
+        lessons = [lesson(self.group, self.smith, 5)]
+        table = SubstitutionTable([Sub(6, self.group)], lessons)
+
+        self.assertEqual(table.before, {})
+        self.assertEqual(table.released, {6: [(self.group, None)]})
+
+
+class TestDateTimetable(TestCase):
+
+    def setUp(self):
+        self.smith, self.jones = Entity(1), Entity(2)
+        self.group = Entity(10)
+        self.other = Entity(11)
+        self.monday = datetime.date(2010, 3, 15)
+        self.timetable = Timetable(1, [lesson(self.group, self.smith, 1),
+                                       lesson(self.group, self.smith, 2),
+                                       lesson(self.other, self.smith, 3)])
+
+    def build(self, *subs):
+        return DateTimetable.build(self.timetable, self.monday, list(subs))
+
+    def test_without_substitutions(self):
+        timetable = self.build()
+
+        self.assertEqual(timetable.lessons, self.timetable.lessons)
+
+    def test_other_weekday(self):
+        timetable = DateTimetable.build(self.timetable,
+                                        datetime.date(2010, 3, 16), [])
+
+        self.assertEqual(timetable.lessons, [])
+
+    def test_released_group(self):
+        timetable = self.build(Sub(2, self.group))
+
+        self.assertEqual([l.order for l in timetable.group_lessons(10)], [1])
+        self.assertEqual([l.order for l in timetable.teacher_lessons(1)],
+                         [1, 3])
+
+    def test_substitute_takes_over(self):
+        sub = Sub(1, self.group, self.jones)
+        timetable = self.build(sub)
+
+        lessons = timetable.teacher_lessons(2, 0, 1)
+        self.assertEqual(len(lessons), 1)
+        self.assertTrue(lessons[0].substitution is sub)
+        self.assertEqual(lessons[0].room, 1)
+        self.assertEqual(timetable.teacher_lessons(1, 0, 1), [])
+
+    def test_part_substituted(self):
+        timetable = self.build(Sub(1, self.group, self.jones, part=2))
+
+        lessons = timetable.group_lessons(10, 0, 1)
+        self.assertEqual([(l.teacher_id, l.part) for l in lessons],
+                         [(1, 1), (2, 2)])
+
+
+class TestSubstitutionWeek(TestCase):
+
+    def test_monday_of(self):
+        monday = datetime.date(2010, 3, 15)
+        for i in range(7):
+            date = monday + datetime.timedelta(i)
+            self.assertEqual(SubstitutionWeek.monday_of(date), monday)
+
+    def test_tables_per_day(self):
+        smith, jones, group = Entity(1), Entity(2), Entity(10)
+        lessons = [lesson(group, smith, 1), lesson(group, smith, 1, day=2)]
+        wednesday = datetime.date(2010, 3, 17)
+        week = SubstitutionWeek.build(datetime.date(2010, 3, 15),
+                                      [Sub(1, group, jones, date=wednesday)],
+                                      lessons)
+
+        self.assertEqual([date.weekday() for date, table in week.tables],
+                         range(5))
+        tables = dict(week.tables)
+        self.assertEqual(tables[wednesday].before,
+                         {smith: {1: [(group, None)]}})
+        self.assertEqual(tables[wednesday].after,
+                         {jones: {1: [(group, None)]}})
+        self.assertEqual(tables[datetime.date(2010, 3, 15)].before, {})
+
+
+class TestOccupancy(TestCase):
+
+    def setUp(self):
+        self.monday = datetime.date(2010, 3, 15)
+        self.smith = Entity(1, u'Smith')
+        self.jones = Entity(2, u'Jones')
+        self.brown = Entity(3, u'Brown')
+        self.white = Entity(4, u'White')
+        self.group, self.other = Entity(10), Entity(11)
+        self.timetable = Timetable(1, [
+            lesson(self.group, self.smith, 1, subject=5),
+            lesson(self.other, self.jones, 1),
+            lesson(self.other, self.brown, 2, subject=5),
+            lesson(self.other, self.white, 2, day=1),
+            lesson(self.other, self.white, 3, day=1),
+        ])
+        self.occupancy = Occupancy(self.timetable)
+
+    def tearDown(self):
+        DateTimetable.invalidate()
+
+    def overlay(self, *subs):
+        timetable = DateTimetable.build(self.timetable, self.monday, subs)
+        DateTimetable._timetables[(1, self.monday)] = timetable
+
+    def test_slots(self):
+        mask = slot(0, 1) | slot(4, 8) | slot(2, 3)
+        self.assertEqual(slots(mask), [(0, 1), (2, 3), (4, 8)])
+        self.assertEqual(count(mask), 3)
+        self.assertEqual(slots(0), [])
+
+    def test_teacher_mask(self):
+        self.assertEqual(self.occupancy.teacher(4),
+                         slot(1, 2) | slot(1, 3))
+        self.assertEqual(self.occupancy.teacher(5), 0)
+
+    def test_suggest(self):
+        self.overlay()
+        suggestions = self.occupancy.suggest(self.monday, 1, 10)
+
+        # Smith has the lesson, Jones is busy, Brown teaches the subject
+        self.assertEqual([(e, match, load) for e, match, load in suggestions],
+                         [(self.brown, True, 1), (self.white, False, 2)])
+
+    def test_suggest_with_substitutions(self):
+        self.overlay(Sub(1, self.other, self.white))
+        suggestions = self.occupancy.suggest(self.monday, 1, 10)
+
+        # White substitutes Jones, who is absent
+        self.assertEqual([e for e, match, load in suggestions], [self.brown])
+
+    def test_substituted_teacher_suggested_later(self):
+        # Smith's lesson is taken over by Jones, Smith is still at school
+        self.overlay(Sub(1, self.group, self.jones))
+        suggestions = self.occupancy.suggest(self.monday, 3, 11)
+
+        self.assertTrue(self.smith in [e for e, match, load in suggestions])
+        suggestions = self.occupancy.suggest(self.monday, 1, 11)
+        self.assertFalse(self.smith in [e for e, match, load in suggestions])
+
+    def test_substituted_part(self):
+        self.timetable = Timetable(1, [
+            lesson(self.group, self.smith, 1, part=1),
+            lesson(self.group, self.jones, 1, part=2)])
+        self.occupancy = Occupancy(self.timetable)
+        self.overlay(Sub(1, self.group, self.brown, part=1))
+        masks, absent = self.occupancy.teachers_on(self.monday)
+
+        # Jones still teaches the second part
+        self.assertEqual(absent, {1: slot(0, 1)})
+        self.assertEqual(masks[3], slot(0, 1))
+
+    def test_free_rooms(self):
+        self.assertEqual(self.occupancy.rooms(), [1])
+        self.assertEqual(self.occupancy.free_rooms([(0, 3)]), [1])
+        self.assertEqual(self.occupancy.free_rooms([(0, 3), (0, 2)]), [])
+        self.assertEqual(self.occupancy.free_rooms([(0, 3)], exclude=[1]),
+                         [])
+
+    def test_room_schedule(self):
+        schedule = self.timetable.room_schedule(1)
+
+        self.assertEqual(len(schedule), 5)
+        self.assertEqual([len(lessons) for lessons in schedule[0]], [2, 1])
+        self.assertEqual(schedule[1][0], None)
+        self.assertEqual(schedule[2], [])
+
+    def test_group_mask(self):
+        occupancy = Occupancy(Timetable(1, [
+            lesson(self.group, self.smith, 1, part=1),
+            lesson(self.group, self.jones, 2)]))
+
+        self.assertEqual(occupancy.group(10, 1), slot(0, 1) | slot(0, 2))
+        self.assertEqual(occupancy.group(10, 2), slot(0, 2))
+        self.assertEqual(occupancy.group(10), slot(0, 1) | slot(0, 2))
+
+    def test_free_periods(self):
+        free = self.occupancy.free_periods(groups=[(11, None)],
+                                           teachers=[1])
+
+        self.assertEqual(self.occupancy.orders, 3)
+        self.assertEqual(len(free), 15 - 4)
+        self.assertFalse((0, 1) in free)
+        self.assertFalse((1, 3) in free)
+        self.assertTrue((0, 3) in free)
+
+
+class TestLuckyCycle(TestCase):
+
+    def setUp(self):
+        self.today = datetime.date(2010, 3, 15)
+        LuckyCycle._current = LuckyCycle(5, 7, [3, 4], 7, self.today,
+                                         self.today)
+
+    def tearDown(self):
+        LuckyCycle.invalidate()
+
+    def lucky(self, id, days, number):
+        lucky = LuckyNumber(self.today + datetime.timedelta(days), number)
+        lucky.id = id
+        return lucky
+
+    def test_left(self):
+        self.assertEqual(LuckyCycle._current.left(), [1, 2, 5])
+
+    def test_new_number_applied(self):
+        LuckyCycle.changed(self.lucky(8, 1, 1))
+
+        cycle = LuckyCycle._current
+        self.assertEqual(cycle.left(), [2, 5])
+        self.assertEqual(cycle.count, 8)
+
+    def test_cycle_restarts(self):
+        LuckyCycle.changed(self.lucky(8, 1, 1))
+        LuckyCycle.changed(self.lucky(9, 2, 2))
+        LuckyCycle.changed(self.lucky(10, 3, 5))
+
+        self.assertEqual(LuckyCycle._current.left(), [1, 2, 3, 4, 5])
+
+    def test_other_changes_invalidate(self):
+        LuckyCycle.changed(self.lucky(5, -3, 1))
+
+        self.assertTrue(LuckyCycle._current is None)
+
+
+class TestLuckyCurrent(TestCase):
+
+    def test_next_change(self):
+        morning = datetime.datetime(2010, 3, 15, 8, 30)
+        evening = datetime.datetime(2010, 3, 15, 15, 0)
+
+        self.assertEqual(LuckyCurrent.next_change(15, morning),
+                         datetime.datetime(2010, 3, 15, 15, 0))
+        self.assertEqual(LuckyCurrent.next_change(15, evening),
+                         datetime.datetime(2010, 3, 16, 15, 0))
+
+    def test_is_fresh(self):
+        now = datetime.datetime(2010, 3, 15, 14, 59)
+        current = LuckyCurrent(15, None, [],
+                               LuckyCurrent.next_change(15, now))
+
+        self.assertTrue(current.is_fresh(15, now))
+        self.assertFalse(current.is_fresh(14, now))
+        self.assertFalse(current.is_fresh(15, now + datetime.timedelta(
+                                                            minutes=1)))
+        self.assertEqual(current.seconds_left(now), 60)
+
+
+class TestPersonSearch(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestPersonSearch, self).setUp()
+        self.teacher = Educator(u'mgr', u'Anna', u'\u0141\u0105cka', False)
+        self.student = Student(u'Jan', u'\u0141ACKI')
+        self.other = Student(u'Piotr', u'Nowak')
+        self.session.add_all([self.teacher, self.student, self.other])
+        self.session.commit()
+
+    def test_fold(self):
+        self.assertEqual(Person.fold(u'\u0141\u0105cka'), u'lacka')
+        self.assertEqual(Person.fold(u'\u017b\xd3\u0141W'), u'zolw')
+        self.assertEqual(Person.fold('Nowak'), u'nowak')
+
+    def test_search_name_synced(self):
+        self.student.last_name = u'\u015awi\u0105tek'
+        self.assertEqual(self.student.search_name, u'swiatek')
+
+    def test_exact(self):
+        found = Person.query_search(u'LACKA').all()
+        self.assertEqual(found, [(self.teacher, self.teacher.id)])
+
+    def test_prefix(self):
+        found = Person.query_search(u'\u0142ac', prefix=True).all()
+        self.assertEqual(found, [(self.teacher, self.teacher.id),
+                                 (self.student, None)])
+
+    def test_subclass(self):
+        self.assertEqual(Student.query_search(u'lac', prefix=True).all(),
+                         [self.student])
+
+
+class TestBellSchedule(TestCase):
+
+    def setUp(self):
+        self.bells = BellSchedule([], datetime.date(2010, 3, 15))
+
+    def resolve(self, hour, minute):
+        return self.bells.resolve(datetime.datetime(2010, 3, 15, hour,
+                                                    minute))
+
+    def test_before_first_bell(self):
+        self.assertEqual(self.resolve(7, 0), (None, 1, 55 * 60))
+
+    def test_during_lesson(self):
+        self.assertEqual(self.resolve(8, 0), (1, 2, 55 * 60))
+
+    def test_break_belongs_to_preceding_lesson(self):
+        self.assertEqual(self.resolve(8, 45), (1, 2, 10 * 60))
+
+    def test_last_lesson(self):
+        self.assertEqual(self.resolve(14, 0), (7, None, 45 * 60))
+
+    def test_after_last_lesson(self):
+        self.assertEqual(self.resolve(15, 0), (None, None, 9 * 3600))
+
+    def test_weekday_bells(self):
+        bells = BellSchedule([(4, 1, datetime.time(8), datetime.time(8, 30))],
+                             datetime.date(2010, 3, 15))
+        friday = datetime.datetime(2010, 3, 19, 8, 10)
+        self.assertEqual(bells.resolve(friday), (1, None, 20 * 60))
+        self.assertEqual(bells.order(friday.replace(day=15)), 1)
+
+
+class Recorder(object):
+    """Cache recording the changes it is notified of."""
+    changes = []
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        cls.changes.append((instance.order, deleted))
+
+
+class HistoryRecorder(object):
+    """Cache recording previous values of changed bells' orders."""
+    changes = []
+
+    @classmethod
+    def changed(cls, instance, deleted=False):
+        cls.changes.append(get_history(instance, 'order')[2])
+
+
+class TestCacheExtension(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestCacheExtension, self).setUp()
+        Recorder.changes = []
+        HistoryRecorder.changes = []
+        watch(Bell, Recorder)
+        year = SchoolYear(datetime.date(2009, 9, 1),
+                          datetime.date(2010, 6, 30))
+        self.bell = Bell(year, 1, datetime.time(8), datetime.time(8, 45))
+        self.session.add(self.bell)
+
+    def tearDown(self):
+        _caches[Bell].remove(Recorder)
+        super(TestCacheExtension, self).tearDown()
+
+    def test_registered_caches_notified(self):
+        self.session.commit()
+        self.bell.order = 2
+        self.session.commit()
+        self.session.delete(self.bell)
+        self.session.commit()
+
+        self.assertEqual(Recorder.changes, [(1, False), (2, False),
+                                            (2, True)])
+
+    def test_rolled_back_changes_ignored(self):
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+
+        self.assertEqual(Recorder.changes, [])
+
+    def test_previous_values_kept(self):
+        self.session.commit()
+        self.assertEqual(self.bell.order, 1)
+        watch(Bell, HistoryRecorder)
+        try:
+            self.bell.order = 2
+            self.session.flush()
+            self.session.expire_all()
+            self.session.commit()
+        finally:
+            _caches[Bell].remove(HistoryRecorder)
+
+        self.assertEqual(HistoryRecorder.changes, [[1]])
+
+
+class TestMembershipIndexCommit(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestMembershipIndexCommit, self).setUp()
+        self.index = MembershipIndex._current = \
+                MembershipIndex([], datetime.date.today())
+        year = SchoolYear(datetime.date(2009, 9, 1),
+                          datetime.date(2010, 6, 30))
+        self.student = Student(u'Jan', u'Kowalski')
+        self.group = Group(u'inf', year)
+        self.session.add(GroupMembership(self.group, 2, self.student,
+                                         year.start))
+
+    def tearDown(self):
+        MembershipIndex.invalidate()
+        super(TestMembershipIndexCommit, self).tearDown()
+
+    def test_applied_on_commit(self):
+        self.session.flush()
+        self.assertEqual(self.index.groups(self.student.id), [])
+        self.session.commit()
+
+        self.assertEqual(self.index.groups(self.student.id),
+                         [(self.group.id, 2)])
+
+    def test_rollback_discards(self):
+        self.session.flush()
+        student_id = self.student.id
+        self.session.rollback()
+        self.session.commit()
+
+        self.assertEqual(self.index.groups(student_id), [])
+
+
+class TestLuckyCycleCommit(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestLuckyCycleCommit, self).setUp()
+        self.today = datetime.date(2010, 3, 15)
+        self.cycle = LuckyCycle._current = \
+                LuckyCycle(5, 0, [], 0, None, self.today)
+
+    def tearDown(self):
+        LuckyCycle.invalidate()
+        super(TestLuckyCycleCommit, self).tearDown()
+
+    def test_failed_commit_not_applied(self):
+        self.session.add(LuckyNumber(self.today, 1))
+        self.session.commit()
+        self.assertEqual(LuckyCycle._current.left(), [2, 3, 4, 5])
+
+        # The first number is flushed before the second one fails
+        self.session.add(LuckyNumber(self.today + datetime.timedelta(1), 2))
+        self.session.add(LuckyNumber(self.today, 3))
+        self.assertRaises(IntegrityError, self.session.commit)
+
+        self.assertEqual(LuckyCycle._current.left(), [2, 3, 4, 5])
+
+
+class TestSubstitutionCommit(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestSubstitutionCommit, self).setUp()
+        self.monday = datetime.date(2010, 3, 15)
+        self.tuesday = datetime.date(2010, 3, 16)
+        year = SchoolYear(datetime.date(2009, 9, 1),
+                          datetime.date(2010, 6, 30))
+        self.group = Group(u'inf', year)
+        for date in (self.monday, self.tuesday):
+            DateTimetable._timetables[(1, date)] = \
+                    DateTimetable(1, date, [], [])
+
+    def tearDown(self):
+        DateTimetable.invalidate()
+        SubstitutionWeek.invalidate()
+        super(TestSubstitutionCommit, self).tearDown()
+
+    def test_datetime_invalidates_date(self):
+        self.session.add(Substitution(datetime.datetime(2010, 3, 15), 1,
+                                      self.group))
+        self.session.commit()
+
+        self.assertEqual(DateTimetable._timetables.keys(),
+                         [(1, self.tuesday)])
+
+    def test_datetime_invalidates_week(self):
+        next_monday = self.monday + datetime.timedelta(7)
+        for monday in (self.monday, next_monday):
+            SubstitutionWeek._weeks[(1, monday)] = \
+                    SubstitutionWeek(monday, [])
+        self.session.add(Substitution(datetime.datetime(2010, 3, 17), 1,
+                                      self.group))
+        self.session.commit()
+
+        self.assertEqual(SubstitutionWeek._weeks.keys(), [(1, next_monday)])
+
+    def test_moved_invalidates_both_weeks(self):
+        next_monday = self.monday + datetime.timedelta(7)
+        sub = Substitution(self.monday, 1, self.group)
+        self.session.add(sub)
+        self.session.commit()
+        for monday in (self.monday, next_monday):
+            SubstitutionWeek._weeks[(1, monday)] = \
+                    SubstitutionWeek(monday, [])
+
+        self.assertEqual(sub.date, self.monday)
+        sub.date = next_monday
+        self.session.commit()
+        self.assertEqual(SubstitutionWeek._weeks, {})
+
+    def test_moved_invalidates_both_dates(self):
+        sub = Substitution(datetime.date(2010, 3, 1), 1, self.group)
+        self.session.add(sub)
+        self.session.commit()
+        self.assertEqual(len(DateTimetable._timetables), 2)
+
+        self.assertEqual(sub.date, datetime.date(2010, 3, 1))
+        sub.date = self.monday
+        self.session.commit()
+        self.assertEqual(DateTimetable._timetables.keys(),
+                         [(1, self.tuesday)])
+
+        self.assertEqual(sub.date, self.monday)
+        sub.date = self.tuesday
+        self.session.commit()
+        self.assertEqual(DateTimetable._timetables, {})
+
+
+class TestSubstitutionRange(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestSubstitutionRange, self).setUp()
+        year = SchoolYear(datetime.date(2009, 9, 1),
+                          datetime.date(2010, 6, 30))
+        groups = [Group(u'g%d' % i, year) for i in range(3)]
+        self.monday = datetime.date(2010, 3, 15)
+        self.tuesday = datetime.date(2010, 3, 16)
+        self.subs = [Substitution(self.monday, 1, groups[0]),
+                     Substitution(self.monday, 2, groups[0]),
+                     Substitution(self.monday, 2, groups[1]),
+                     Substitution(self.monday, 2, groups[2]),
+                     Substitution(self.tuesday, 1, groups[0])]
+        # Inserted out of order
+        self.session.add_all(reversed(self.subs))
+        self.session.commit()
+
+    def test_ordered(self):
+        self.assertEqual(Substitution.query_range().all(),
+                         sorted(self.subs, key=lambda s: s.key))
+
+    def test_after_key(self):
+        ordered = Substitution.query_range().all()
+        # The boundary splits substitutions of the same date and order
+        page = Substitution.query_range().limit(3).all()
+        rest = Substitution.query_range(after=page[-1].key).all()
+
+        self.assertEqual(page + rest, ordered)
+        self.assertEqual(Substitution.query_range(after=ordered[-1].key).\
+                         all(), [])
+
+    def test_until_inclusive(self):
+        found = Substitution.query_range(until=self.monday).all()
+        self.assertEqual(len(found), 4)
+        self.assertTrue(all(s.date == self.monday for s in found))
+
+        found = Substitution.query_range(since=self.tuesday,
+                                         until=self.tuesday).all()
+        self.assertEqual(found, [self.subs[-1]])
+
+    def test_after_key_with_until(self):
+        page = Substitution.query_range(until=self.monday).limit(2).all()
+        rest = Substitution.query_range(until=self.monday,
+                                        after=page[-1].key).all()
+        self.assertEqual([s.date for s in rest], [self.monday] * 2)
+
+
+class TestBulkInsert(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.year = SchoolYear(datetime.date(2009, 9, 1),
+                               datetime.date(2010, 6, 30))
+        self.session.add(self.year)
+        self.session.commit()
+        self.years = SchoolYear.__table__
+        self.groups = Group.__table__
+
+    def test_insert(self):
+        # Groups are queued first and flushed in batches of two, years
+        # still have to be inserted before them
+        with BulkInsert(self.engine, 'test', batch_size=2) as bulk:
+            names = [u'1a', u'1b', u'1c']
+            year_id = bulk.next_id(self.years)
+            ids = [bulk.add(self.groups, name=name, year_id=year_id)
+                   for name in names]
+            bulk.add(self.years, id=year_id, start=datetime.date(2010, 9, 1),
+                     end=datetime.date(2011, 6, 30))
+
+        self.assertEqual(year_id, self.year.id + 1)
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(bulk.count, 4)
+        groups = self.session.query(Group).order_by(Group.id).all()
+        self.assertEqual([(g.id, g.name) for g in groups],
+                         zip(ids, names))
+        self.assertTrue(all(g.year_id == year_id for g in groups))
+        self.assertEqual(self.session.query(SchoolYear).get(year_id).start,
+                         datetime.date(2010, 9, 1))
+
+    def test_rollback(self):
+        try:
+            with BulkInsert(self.engine, 'test', batch_size=2) as bulk:
+                for name in (u'1a', u'1b', u'1c'):
+                    bulk.add(self.groups, name=name, year_id=self.year.id)
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(self.session.query(Group).count(), 0)
+
+
+class TestTimetableCommit(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestTimetableCommit, self).setUp()
+        year = SchoolYear(datetime.date(2009, 9, 1),
+                          datetime.date(2010, 6, 30))
+        self.schedule = Schedule(year, datetime.date(2009, 9, 1))
+        self.group = Group(u'inf', year)
+        self.subject = Subject(u'Matematyka', u'mat')
+        self.teacher = Educator(u'mgr', u'Jan', u'Kowalski')
+        self.session.add_all([self.schedule, self.group, self.subject,
+                              self.teacher])
+        self.session.commit()
+        self.schedule_id = self.schedule.id
+
+    def tearDown(self):
+        Timetable.invalidate()
+        Occupancy.invalidate()
+        super(TestTimetableCommit, self).tearDown()
+
+    def add_lesson(self, order):
+        self.session.add(Lesson(self.schedule, self.group, None, self.subject,
+                                self.teacher, 0, order, 1))
+        self.session.commit()
+
+    def test_lesson_refreshes(self):
+        self.assertEqual(Timetable.get(self.schedule_id).lessons, [])
+        self.add_lesson(1)
+
+        lessons = Timetable.get(self.schedule_id).lessons
+        self.assertEqual([l.order for l in lessons], [1])
+
+    def test_renamed_teacher(self):
+        self.add_lesson(1)
+        Timetable.get(self.schedule_id)
+        self.teacher.last_name = u'Nowak'
+        self.session.commit()
+
+        lesson = Timetable.get(self.schedule_id).lessons[0]
+        self.assertEqual(lesson.teacher.last_name, u'Nowak')
+
+    def test_occupancy_refreshes(self):
+        self.assertEqual(Occupancy.get(self.schedule_id).teacher(
+                         self.teacher.id), 0)
+        self.add_lesson(2)
+
+        self.assertEqual(Occupancy.get(self.schedule_id).teacher(
+                         self.teacher.id), slot(0, 2))
@@ -0,0 +1,82 @@
+import pickle
+import datetime
+from unittest import TestCase
+
+from sis.lib.parsers import LuckyNumberParser, TeachersParser, \
+        StudentsParser
+from sis.lib.parsers.base import LineError, ParserError
+
+
+class TestErrors(TestCase):
+
+    def test_pickle(self):
+        # Errors are passed back from the students parsing processes
+        error = pickle.loads(pickle.dumps(
+                LineError(3, u'Nowak', ParserError('Bad line'))))
+        self.assertEqual(error.number, 3)
+        self.assertEqual(str(error), 'Line 3 :: Bad line :: Nowak')
+
+
+class TestLuckyNumberParser(TestCase):
+
+    def test_lazy(self):
+        def lines():
+            yield u'2010-03-15 - 1\n'
+            yield u'2010-03-16 - 2\n'
+            raise AssertionError('Read past the second line')
+
+        numbers = iter(LuckyNumberParser(lines()))
+        lucky = numbers.next()
+        self.assertEqual(lucky.date, datetime.date(2010, 3, 15))
+        self.assertEqual(lucky.number, 1)
+        self.assertEqual(numbers.next().number, 2)
+
+    def test_empty_lines_skipped(self):
+        lines = [u'2010-03-15 - 1\n', u'\n', u'2010-03-16 - 2\n', u'\n']
+        numbers = list(LuckyNumberParser(lines))
+        self.assertEqual([l.number for l in numbers], [1, 2])
+
+    def test_duplicate_date(self):
+        lines = [u'2010-03-15 - 1', u'2010-03-16 - 2', u'2010-03-15 - 3']
+        try:
+            list(LuckyNumberParser(lines))
+        except LineError as e:
+            self.assertEqual(e.number, 3)
+        else:
+            self.fail('Duplicate date not detected')
+
+
+class TestTeachersParser(TestCase):
+
+    def test_parse(self):
+        lines = [u'mgr Kowalski Jan M\n', u'dr Nowak Anna F\n']
+        teachers = list(TeachersParser(lines))
+        self.assertEqual([t.last_name for t in teachers],
+                         [u'Kowalski', u'Nowak'])
+
+    def test_malformed(self):
+        try:
+            list(TeachersParser([u'mgr Kowalski Jan M', u'Nowak']))
+        except LineError as e:
+            self.assertEqual(e.number, 2)
+        else:
+            self.fail('Malformed line not detected')
+
+
+class TestStudentsParser(TestCase):
+
+    def test_records(self):
+        lines = [u'#01.09.2009-30.06.2010', u'#inf', u'Nowak Janina - F',
+                 u'Kowalski Jan Andrzej M rwos', u'Adamski Piotr - M']
+        year, groups, students, memberships = \
+                StudentsParser(lines).records()
+
+        self.assertEqual(year, (datetime.date(2009, 9, 1),
+                                datetime.date(2010, 6, 30)))
+        self.assertEqual(sorted(groups), [u'inf', u'rwos'])
+        self.assertEqual(len(students), 3)
+        parts = dict((students[i][2], part)
+                     for i, group, part, since in memberships
+                     if group == u'inf')
+        self.assertEqual(parts, {u'Adamski': 1, u'Kowalski': 1,
+                                 u'Nowak': 2})
@@ -4,10 +4,12 @@ import sys
 import codecs
 import getpass
 import logging
+import multiprocessing
+import datetime
 
 import pylons.test
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.reflection import Inspector
 
 from sis.config.environment import load_environment
 
@@ -15,13 +17,22 @@ from sis.model import Session
 from sis.model import Base
 from sis.model import AuthUser
 from sis.model import Group
+from sis.model import Person
 from sis.model import Subject
+from sis.model import Educator
+from sis.model import Student
+from sis.model import SchoolYear
+from sis.model import GroupMembership
+from sis.model import LuckyNumber
+from sis.model import Schedule
+from sis.model import Lesson
 
 from sis.lib.parsers import TeachersParser
 from sis.lib.parsers import StudentsParser
 from sis.lib.parsers import LuckyNumberParser
 from sis.lib.parsers import FullScheduleParser
 from sis.lib.parsers import SubjectsParser
+from sis.lib.bulk import BulkInsert
 
 log = logging.getLogger(__name__)
 
@@ -51,64 +62,149 @@ def setup_admin():
 
     return user
 
+def update_search_names():
+    """
+    Add and fill people's search names, missing from older databases.
+
+    """
+    inspector = Inspector.from_engine(Session.bind)
+    columns = [column['name'] for column in inspector.get_columns('people')]
+    if 'search_name' not in columns:
+        log.info("Adding people's search names...")
+        Session.bind.execute(
+            'ALTER TABLE people ADD COLUMN search_name VARCHAR(256)')
+
+    for person in Session.query(Person).filter(Person.search_name == None):
+        person.search_name = Person.fold(person.last_name)
+    Session.commit()
+
+def create_indexes():
+    """
+    Create indexes missing from already existing tables.
+
+    ``create_all`` creates indexes only together with their tables.
+
+    """
+    inspector = Inspector.from_engine(Session.bind)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Creating index %s..." % index.name)
+                index.create(bind=Session.bind)
+
+def _person_row(first_name, second_name, last_name, is_male):
+    """
+    Return row of the ``people`` table.
+
+    """
+    return dict(first_name=first_name, second_name=second_name,
+                last_name=last_name, is_male=is_male,
+                search_name=Person.fold(last_name))
+
 def parse_teachers(path):
     """
     Parse teachers file.
 
     :param path: Path to the parsable teachers file.
 
+    :retval: Ids of the teachers keyed by last name.
+
     """
     log.info("Parsing teachers...")
 
     teachers = {}
-    teachers_file = codecs.open(path, 'r', 'utf-8')
-    for teacher in TeachersParser(teachers_file):
-        teachers[teacher.last_name] = teacher
-        Session.add(teacher)
-
-    Session.commit()
+    with BulkInsert(Session.bind, "Teachers") as bulk:
+        for teacher in TeachersParser(path):
+            id = bulk.add(Person.__table__, **_person_row(teacher.first_name,
+                    teacher.second_name, teacher.last_name, teacher.is_male))
+            bulk.add(Educator.__table__, id=id, title=teacher.title)
+            teachers[teacher.last_name] = id
 
     log.info("Teachers parsed and committed.")
 
     return teachers
 
-def parse_students(students_dir):
+def parse_students_file(path):
     """
-    Parse directory with students files.
+    Parse students file into plain records (see
+    :meth:`sis.lib.parsers.StudentsParser.records`), so that it can be done
+    in a worker process.
 
-    :param students_dir: Directory with parsable students files.
+    """
+    return StudentsParser(path).records()
 
+def parse_students(students_dir, processes=None):
     """
-    log.info("Parsing students...")
+    Parse directory with students files.
 
-    years = {}
+    Files are parsed in a pool of processes, records are merged and
+    inserted by the main process.
 
-    for path in os.listdir(students_dir):
-        students_file = codecs.open(os.path.join(students_dir, path), 'r',
-                                    'utf-8').readlines()
-        parser = StudentsParser(students_file)
-        years[parser.year] = parser.groups
+    :param students_dir: Directory with parsable students files.
 
-        for students in parser.students.values():
-            Session.add_all(students)
+    :param processes: Number of processes, one per CPU if None. Files are
+                      parsed by the main process itself if 1.
+    :type processes: :class:`int`
 
-    groups = {}
+    :retval: (current school year's id, groups) pair, where groups are ids
+             of the groups keyed by full name.
+
+    """
+    log.info("Parsing students...")
 
-    sorted_years = sorted(years.keys(), key=lambda y: y.start)
-    for index, year in enumerate(reversed(sorted_years)):
+    paths = [os.path.join(students_dir, path)
+             for path in os.listdir(students_dir)]
+    if processes == 1 or len(paths) < 2:
+        years = map(parse_students_file, paths)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            years = pool.map(parse_students_file, paths)
+        finally:
+            pool.close()
+            pool.join()
+    years.sort(key=lambda records: records[0][0], reverse=True)
+
+    prefixes = []
+    for index, records in enumerate(years):
+        start = records[0][0]
         user_index = raw_input("Enter index for school year %d/%d [%d]: " \
-                          % (year.start.year, year.start.year + 1, index+1))
+                          % (start.year, start.year + 1, index+1))
         if user_index == '':
             user_index = str(index+1)
+        prefixes.append(user_index)
 
-        for group in years[year]:
-            groups[user_index+group.name] = group
-
-    Session.commit()
+    groups = {}
+    year_ids = []
+    with BulkInsert(Session.bind, "Students") as bulk:
+        for prefix, records in zip(prefixes, years):
+            (start, end), group_names, students, memberships = records
+            year_id = bulk.add(SchoolYear.__table__, start=start, end=end)
+            year_ids.append(year_id)
+
+            group_ids = {}
+            for name in group_names:
+                group_ids[name] = bulk.add(Group.__table__, name=name,
+                                           year_id=year_id)
+                groups[prefix + name] = group_ids[name]
+
+            student_ids = []
+            for student in students:
+                id = bulk.add(Person.__table__, **_person_row(*student))
+                bulk.add(Student.__table__, id=id)
+                student_ids.append(id)
+
+            for index, group_name, part, since in memberships:
+                bulk.add(GroupMembership.__table__,
+                         student_id=student_ids[index],
+                         group_id=group_ids[group_name],
+                         second_part=part == 2, since=since, to=None,
+                         active=True)
 
     log.info("Students (and groupd) parsed and committed.")
 
-    return sorted_years[-1], groups
+    return year_ids[0], groups
 
 def parse_subjects(path):
     """
@@ -116,15 +212,17 @@ def parse_subjects(path):
 
     :param path: Path to parsable subjects file.
 
+    :retval: Ids of the subjects keyed by short name.
+
     """
     log.info("Parsing subjects...")
 
     subjects = {}
-    for subject in SubjectsParser(path):
-        subjects[subject.short] = subject
-        Session.add(subject)
-
-    Session.commit()
+    with BulkInsert(Session.bind, "Subjects") as bulk:
+        for subject in SubjectsParser(path):
+            subjects[subject.short] = bulk.add(Subject.__table__,
+                                               name=subject.name,
+                                               short=subject.short)
 
     log.info("Subjects parsed and committed.")
 
@@ -139,56 +237,96 @@ def parse_numbers(path):
     """
     log.info("Parsing lucky numbers...")
 
-    lucky_numbers_file = codecs.open(path, 'r', 'utf-8')
-    for number in LuckyNumberParser(lucky_numbers_file):
-        Session.add(number)
-    Session.commit()
+    with BulkInsert(Session.bind, "Lucky numbers") as bulk:
+        for number in LuckyNumberParser(path):
+            bulk.add(LuckyNumber.__table__, date=number.date,
+                     number=number.number)
 
     log.info("Lucky numbers parsed and committed.")
 
-def parse_schedule(path, current_year, groups, subjects, teachers):
+def missing_teacher(lesson):
+    """
+    Log lesson row without a teacher and exit.
+
+    """
+    group = Session.query(Group).get(lesson['group_id'])
+    subject = Session.query(Subject).get(lesson['subject_id'])
+
+    error_msg = (
+        u"Integrity error: no teacher set!:\n"
+        "   group: {0}\n"
+        "   first_part: {1}\n"
+        "   second_part: {2}\n"
+        "   subject: {3}\n"
+        "   day: {4}\n"
+        "   order: {5}\n"
+        "   room: {6}")
+    log.error(error_msg.format(group.full_name(), lesson['first_part'],
+        lesson['second_part'], subject.name, lesson['day'], lesson['order'],
+        lesson['room']).encode("utf-8"))
+
+    sys.exit()
+
+def parse_schedule(path, current_year_id, groups, subjects, teachers):
     """
     Parse schedule file.
 
     :param path: Path to parsable schedule file
 
-    :param current_year: Current school year.
-    :type current_year: :class:`sis.model.SchoolYear`
+    :param current_year_id: Current school year's id.
+    :type current_year_id: :class:`int`
 
-    :param groups: Groups.
-    :type groups: dictionary of (Group.full_name(), Group) key/value pair.
+    :param groups: Groups' ids.
+    :type groups: dictionary of (Group.full_name(), id) key/value pair.
 
-    :param subjects: Subjects.
-    :type subjects: dictionary of (Subject.short, Subject) key/value pair.
+    :param subjects: Subjects' ids.
+    :type subjects: dictionary of (Subject.short, id) key/value pair.
 
-    :param teachers: Teachers.
-    :type teachers: dictionary of (Teacher.full_name, Teacher) key/value pair.
+    :param teachers: Teachers' ids.
+    :type teachers: dictionary of (Teacher.last_name, id) key/value pair.
+
+    :retval: The schedule's id.
 
     """
     log.info("Parsing schedule...")
 
-    schedule_file = codecs.open(path, 'r', 'utf-8')
-    sp = FullScheduleParser(schedule_file, current_year, groups, subjects,
-                           teachers)
+    with BulkInsert(Session.bind, "Schedule") as bulk:
+        schedule_id = bulk.next_id(Schedule.__table__)
+        schedule_file = codecs.open(path, 'r', 'utf-8')
+        try:
+            sp = FullScheduleParser(schedule_file, schedule_id, groups,
+                                    subjects, teachers)
+        finally:
+            schedule_file.close()
+
+        for lesson in sp.lessons():
+            if lesson['teacher_id'] is None:
+                missing_teacher(lesson)
+
+        bulk.add(Schedule.__table__, id=schedule_id, year_id=current_year_id,
+                 start=datetime.date.today())
+        for lesson in sp.lessons():
+            bulk.add(Lesson.__table__, **lesson)
 
     log.info("Schedule parsed.")
-    return sp.schedule
+    return schedule_id
 
 def check_rooms(schedule):
-    """Check rooms integrity."""
-    log.info("Checking rooms...")
-    conflicts = schedule.check_rooms(exclude=[100])
+    """Check rooms, teachers and groups integrity."""
+    log.info("Checking rooms, teachers and groups...")
+    conflicts = schedule.conflicts(exclude_rooms=[100])
     if len(conflicts) == 0:
-        log.info("Rooms checked.")
+        log.info("Rooms, teachers and groups checked.")
     else:
-        error_msg = u"Rooms conflict(s) detected!"
+        error_msg = u"Schedule conflict(s) detected!"
         for c in conflicts:
-            error_msg += u"\n\troom: {0}\n\tday: {1}\n\torder: {2}".format(
-                c[0].room, c[0].day, c[0].order)
-            for l in c:
-                error_msg += u"\n\t\t# group: {0}\n\t\t  teacher: {1}".format(
-                    l.group.full_name(),
-                    l.teacher.name_with_title)
+            error_msg += u"\n\t{0}: {1}\n\tday: {2}\n\torder: {3}".format(
+                c.kind, c.key, c.day, c.order)
+            for l in c.lessons:
+                error_msg += (u"\n\t\t# group: {0}{1}\n\t\t  teacher: {2}"
+                              u"\n\t\t  room: {3}").format(
+                    l.group.full_name(), l.part or '',
+                    l.teacher.name_with_title, l.room)
         log.error(error_msg.encode("utf-8"))
 
 def setup_app(command, conf, vars):
@@ -200,6 +338,8 @@ def setup_app(command, conf, vars):
     # Create the tables if they don't already exist
     log.info("Creating tables...")
     Base.metadata.create_all(bind=Session.bind)
+    update_search_names()
+    create_indexes()
     log.info("Schema saved to the database.")
 
     # Run parsers
@@ -217,43 +357,17 @@ def setup_app(command, conf, vars):
 
     # Parse students
     students_dir = conf['students_dir']
-    current_year, groups = parse_students(students_dir)
+    processes = conf.get('students_processes') or None
+    if processes is not None:
+        processes = int(processes)
+    current_year_id, groups = parse_students(students_dir, processes)
 
     # Parse schedule
-    schedule = parse_schedule(conf['schedule_file'], current_year, groups, subjects,
-                   teachers)
-
-    try:
-        Session.commit()
-    except IntegrityError as error:
-        if not error.statement.startswith("INSERT INTO lessons"):
-            raise
-
-        schedule_id, group_id, first_part, second_part, subject_id, \
-            teacher_id, order, day, room = error.params
-
-        # Rollback commit
-        Session.rollback()
-
-        group = Session.query(Group).get(group_id)
-        subject = Session.query(Subject).get(subject_id)
-
-        error_msg = (
-            u"Integrity error: no teacher set!:\n"
-            "   group: {0}\n"
-            "   first_part: {1}\n"
-            "   second_part: {2}\n"
-            "   subject: {3}\n"
-            "   day: {4}\n"
-            "   order: {5}\n"
-            "   room: {6}")
-        log.error(error_msg.format(group.full_name(), first_part, second_part,
-            subject.name, day, order, room).encode("utf-8"))
-
-        sys.exit()
+    schedule_id = parse_schedule(conf['schedule_file'], current_year_id,
+                                 groups, subjects, teachers)
 
     # Check rooms, exclude gym
-    check_rooms(schedule)
+    check_rooms(Session.query(Schedule).get(schedule_id))
 
     # Create superadmin
     setup_admin()